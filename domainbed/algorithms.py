@@ -13,7 +13,11 @@ from domainbed.lib.cvt import tiny_cvt, small_cvt
 from domainbed.lib.t2t_vit import tfsvit_t2t_vit_t_14, atfsvit_t2t_vit_t_14
 from domainbed.lib.t2t_vit import t2t_vit_t_14
 from domainbed.lib import augmix_augmentations
+from domainbed.lib import augmix_batch
+from domainbed.lib.randconv import BatchRandConv
+from domainbed.lib import timing
 from torch.optim import lr_scheduler
+_LRScheduler = getattr(lr_scheduler, "LRScheduler", lr_scheduler._LRScheduler)
 # from domainbed.lib.t2t_vit import *
 from domainbed.lib.t2t_utils import load_for_transfer_learning
 from domainbed.lib.ABA.multi_bnn import Multi_BNN
@@ -24,6 +28,7 @@ import timm
 from transformers import  ViTForImageClassification
 import math
 
+import contextlib
 import copy
 import numpy as np
 from collections import defaultdict, OrderedDict
@@ -110,11 +115,37 @@ class Algorithm(torch.nn.Module):
     Subclasses should implement the following:
     - update()
     - predict()
+
+    update() implementations should run their forward passes and losses
+    under self.forward_pass() and call self.backward(loss) and
+    self.optimizer_step(optimizer) outside of it. With hparams['amp'] set
+    to "fp16" or "bf16" these run the forward pass under autocast and
+    handle loss scaling; they also record the "forward", "backward" and
+    "optimizer_step" phases of --time_phases. Algorithms whose updates
+    differentiate through gradients or interleave several optimizers set
+    SUPPORTS_AMP = False and always train in fp32; those that compute
+    their gradients by hand report only the phases they go through.
+
+    With hparams['compile'], train.py compiles the networks with
+    networks.compile_algorithm; algorithms that deep-copy their networks
+    set SUPPORTS_COMPILE = False.
     """
+    SUPPORTS_AMP = True
+    SUPPORTS_COMPILE = True
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(Algorithm, self).__init__()
         self.hparams = hparams
+        self.amp_dtype = None
+        self.grad_scaler = None
+        amp = hparams.get('amp', " ")
+        if amp != " " and self.SUPPORTS_AMP:
+            # CPU autocast only supports bfloat16
+            if amp == "fp16" and device == "cuda":
+                self.amp_dtype = torch.float16
+                self.grad_scaler = torch.cuda.amp.GradScaler()
+            else:
+                self.amp_dtype = torch.bfloat16
 
     def update(self, minibatches, unlabeled=None):
         """
@@ -129,6 +160,114 @@ class Algorithm(torch.nn.Module):
     def predict(self, x):
         raise NotImplementedError
 
+    def train_env(self, env):
+        """Dataset that the training loader reads for the training
+        environment `env` (`env` itself by default)."""
+        return env
+
+    def autocast(self):
+        """Mixed-precision context for forward passes (a no-op without
+        amp)."""
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device, dtype=self.amp_dtype)
+
+    @contextlib.contextmanager
+    def forward_pass(self):
+        """Context for the forward pass and loss of update(): the "forward"
+        timing phase, under self.autocast()."""
+        with timing.phase("forward"), self.autocast():
+            yield
+
+    def backward(self, loss):
+        with timing.phase("backward"):
+            if self.grad_scaler is None:
+                loss.backward()
+            else:
+                self.grad_scaler.scale(loss).backward()
+
+    def optimizer_step(self, optimizer):
+        with timing.phase("optimizer_step"):
+            if self.grad_scaler is None:
+                optimizer.step()
+            else:
+                # skipped if the scaled gradients overflowed
+                self.grad_scaler.step(optimizer)
+                self.grad_scaler.update()
+
+    def predict_views(self, views):
+        """
+        self.predict on each tensor of `views`, fused into as few forwards
+        over the concatenated views as hparams['fused_views_max_batch']
+        samples per forward allow (0: no limit). Views are predicted
+        separately when the network couples the samples of a forward (e.g.
+        BatchNorm in training mode), where fusing would change the result.
+        """
+        budget = self.hparams.get('fused_views_max_batch', 0)
+        if _batch_coupled(getattr(self, 'network', self)):
+            chunks = [[view] for view in views]
+        else:
+            chunks, size = [[]], 0
+            for view in views:
+                if chunks[-1] and budget > 0 and size + len(view) > budget:
+                    chunks.append([])
+                    size = 0
+                chunks[-1].append(view)
+                size += len(view)
+
+        outs = []
+        for chunk in chunks:
+            if len(chunk) == 1:
+                outs.append(self.predict(chunk[0]))
+            else:
+                outs.extend(self.predict(torch.cat(chunk)).split(
+                    [len(view) for view in chunk]))
+        return outs
+
+    def _optimizers(self):
+        """Optimizers, LR schedulers and the grad scaler held as attributes
+        or in list, tuple and dict attributes (e.g. TRM.olist), by name
+        ("olist.0" for the first optimizer of olist)."""
+        found = {}
+
+        def _collect(name, value):
+            if isinstance(value, (torch.optim.Optimizer, _LRScheduler,
+                                  torch.cuda.amp.GradScaler)):
+                found[name] = value
+            elif isinstance(value, (list, tuple)):
+                for i, item in enumerate(value):
+                    _collect("{}.{}".format(name, i), item)
+            elif isinstance(value, dict):
+                for key, item in value.items():
+                    _collect("{}.{}".format(name, key), item)
+
+        for name, value in vars(self).items():
+            if name != 'hparams':
+                _collect(name, value)
+        return found
+
+    def training_state_dict(self):
+        """
+        State needed to resume training that is not part of state_dict()
+        (buffers such as update_count are): the optimizers and schedulers.
+        """
+        return {name: value.state_dict()
+                for name, value in self._optimizers().items()}
+
+    def load_training_state_dict(self, state):
+        for name, value in self._optimizers().items():
+            if name in state:
+                value.load_state_dict(state[name])
+
+def _batch_coupled(network):
+    """Whether a forward of `network` in its current mode mixes information
+    across the samples of the batch."""
+    return any(module.training and (
+                   isinstance(module, nn.modules.batchnorm._BatchNorm)
+                   or getattr(module, 'BATCH_COUPLED', False))
+               for module in network.modules())
+
+
 class ERM(Algorithm):
     """
     Empirical Risk Minimization (ERM)
@@ -228,16 +367,17 @@ class ERM(Algorithm):
     def update(self, minibatches, unlabeled=None):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-        loss = F.cross_entropy(self.predict(all_x), all_y)
+        with self.forward_pass():
+            loss = F.cross_entropy(self.predict(all_x), all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         if self.hparams['scheduler']:
             self.scheduler.step()
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -275,14 +415,15 @@ class ERM_ViT(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
         
-        output = self.predict(all_x)
-        loss = F.cross_entropy(output, all_y) 
+        with self.forward_pass():
+            output = self.predict(all_x)
+            loss = F.cross_entropy(output, all_y) 
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         out = self.network(x)
@@ -314,15 +455,16 @@ class TFSViT(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        output = self.predict(all_x)
+        with self.forward_pass():
+            output = self.predict(all_x)
 
-        loss = F.cross_entropy(output, all_y)
+            loss = F.cross_entropy(output, all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         out = self.network(x)
@@ -348,15 +490,16 @@ class ATFSViT(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        output = self.predict(all_x)
+        with self.forward_pass():
+            output = self.predict(all_x)
 
-        loss = F.cross_entropy(output, all_y)
+            loss = F.cross_entropy(output, all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         out = self.network(x)
@@ -385,24 +528,25 @@ class SDViT_TFSViT(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        output, output_rb = self.predict_Train(all_x)
+        with self.forward_pass():
+            output, output_rb = self.predict_Train(all_x)
 
-        base_loss = F.cross_entropy(output, all_y)
-        rb_loss = F.kl_div(
-            F.log_softmax(output_rb / self.alpha_KL_temp, dim=1),
-            F.log_softmax(output / self.alpha_KL_temp, dim=1),
-            reduction='sum',
-            log_target=True
-        ) * (self.alpha_KL_temp * self.alpha_KL_temp) / output_rb.numel()
+            base_loss = F.cross_entropy(output, all_y)
+            rb_loss = F.kl_div(
+                F.log_softmax(output_rb / self.alpha_KL_temp, dim=1),
+                F.log_softmax(output / self.alpha_KL_temp, dim=1),
+                reduction='sum',
+                log_target=True
+            ) * (self.alpha_KL_temp * self.alpha_KL_temp) / output_rb.numel()
 
-        # Final_loss
-        loss = base_loss + self.alpha_rb_loss * rb_loss
+            # Final_loss
+            loss = base_loss + self.alpha_rb_loss * rb_loss
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict_Train(self, x):
         out = self.network(x)
@@ -438,24 +582,25 @@ class SDViT(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        output, output_rb = self.predict_Train(all_x)
+        with self.forward_pass():
+            output, output_rb = self.predict_Train(all_x)
 
-        base_loss = F.cross_entropy(output, all_y)
-        rb_loss = F.kl_div(
-            F.log_softmax(output_rb / self.alpha_KL_temp, dim=1),
-            F.log_softmax(output / self.alpha_KL_temp, dim=1),
-            reduction='sum',
-            log_target=True
-        ) * (self.alpha_KL_temp * self.alpha_KL_temp) / output_rb.numel()
+            base_loss = F.cross_entropy(output, all_y)
+            rb_loss = F.kl_div(
+                F.log_softmax(output_rb / self.alpha_KL_temp, dim=1),
+                F.log_softmax(output / self.alpha_KL_temp, dim=1),
+                reduction='sum',
+                log_target=True
+            ) * (self.alpha_KL_temp * self.alpha_KL_temp) / output_rb.numel()
 
-        # Final_loss
-        loss = base_loss + self.alpha_rb_loss * rb_loss
+            # Final_loss
+            loss = base_loss + self.alpha_rb_loss * rb_loss
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict_Train(self, x):
         out = self.network(x)
@@ -472,6 +617,8 @@ class Fish(Algorithm):
     Generalization, Shi et al. 2021.
     """
 
+    SUPPORTS_AMP = False  # inner-loop optimizer over a cloned network
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(Fish, self).__init__(input_shape, num_classes, num_domains,
                                    hparams)
@@ -486,6 +633,17 @@ class Fish(Algorithm):
         )
         self.optimizer_inner_state = None
 
+    def training_state_dict(self):
+        state = super(Fish, self).training_state_dict()
+        # optimizer_inner is rebuilt every step from this state
+        state.pop("optimizer_inner", None)
+        state["optimizer_inner_state"] = self.optimizer_inner_state
+        return state
+
+    def load_training_state_dict(self, state):
+        super(Fish, self).load_training_state_dict(state)
+        self.optimizer_inner_state = state.get("optimizer_inner_state")
+
     def create_clone(self, device):
         self.network_inner = networks.WholeFish(self.input_shape, self.num_classes, self.hparams,
                                                 weights=self.network.state_dict()).to(device)
@@ -520,7 +678,7 @@ class Fish(Algorithm):
         )
         self.network.reset_weights(meta_weights)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -553,6 +711,8 @@ class ARM(ERM):
 class AbstractDANN(Algorithm):
     """Domain-Adversarial Neural Networks (abstract class)"""
 
+    SUPPORTS_AMP = False  # alternating discriminator/generator optimizers
+
     def __init__(self, input_shape, num_classes, num_domains,
                  hparams, conditional, class_balance):
 
@@ -626,7 +786,7 @@ class AbstractDANN(Algorithm):
             self.disc_opt.zero_grad()
             disc_loss.backward()
             self.disc_opt.step()
-            return {'disc_loss': disc_loss.item()}
+            return {'disc_loss': disc_loss.detach()}
         else:
             all_preds = self.classifier(all_z)
             classifier_loss = F.cross_entropy(all_preds, all_y)
@@ -636,7 +796,7 @@ class AbstractDANN(Algorithm):
             self.gen_opt.zero_grad()
             gen_loss.backward()
             self.gen_opt.step()
-            return {'gen_loss': gen_loss.item()}
+            return {'gen_loss': gen_loss.detach()}
 
     def predict(self, x):
         return self.classifier(self.featurizer(x))
@@ -658,6 +818,8 @@ class CDANN(AbstractDANN):
 class IRM(ERM):
     """Invariant Risk Minimization"""
 
+    SUPPORTS_AMP = False  # gradient penalty (create_graph)
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(IRM, self).__init__(input_shape, num_classes, num_domains,
                                   hparams)
@@ -703,12 +865,12 @@ class IRM(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(), 'nll': nll.item(),
-                'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'nll': nll.detach(),
+                'penalty': penalty.detach()}
 
 class VREx(ERM):
     """V-REx algorithm from http://arxiv.org/abs/2003.00688"""
@@ -727,18 +889,19 @@ class VREx(ERM):
         nll = 0.
 
         all_x = torch.cat([x for x, y in minibatches])
-        all_logits = self.network(all_x)
-        all_logits_idx = 0
-        losses = torch.zeros(len(minibatches))
-        for i, (x, y) in enumerate(minibatches):
-            logits = all_logits[all_logits_idx:all_logits_idx + x.shape[0]]
-            all_logits_idx += x.shape[0]
-            nll = F.cross_entropy(logits, y)
-            losses[i] = nll
+        with self.forward_pass():
+            all_logits = self.network(all_x)
+            all_logits_idx = 0
+            losses = torch.zeros(len(minibatches))
+            for i, (x, y) in enumerate(minibatches):
+                logits = all_logits[all_logits_idx:all_logits_idx + x.shape[0]]
+                all_logits_idx += x.shape[0]
+                nll = F.cross_entropy(logits, y)
+                losses[i] = nll
 
-        mean = losses.mean()
-        penalty = ((losses - mean) ** 2).mean()
-        loss = mean + penalty_weight * penalty
+            mean = losses.mean()
+            penalty = ((losses - mean) ** 2).mean()
+            loss = mean + penalty_weight * penalty
 
         if self.update_count == self.hparams['vrex_penalty_anneal_iters']:
             # Reset Adam (like IRM), because it doesn't like the sharp jump in
@@ -749,12 +912,12 @@ class VREx(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(), 'nll': nll.item(),
-                'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'nll': nll.detach(),
+                'penalty': penalty.detach()}
 
 class RandConv_CNN(ERM):
 
@@ -773,6 +936,23 @@ class RandConv_CNN(ERM):
 
         if not self.hparams["eval"]:
             self.rand_conv =  nn.Conv2d(in_channels=input_shape[0], out_channels=input_shape[0], kernel_size=self.ks,stride=1,padding=self.ks//2,bias=False,groups=input_shape[0])
+
+        if self.hparams["randconv_batched"]:
+            # per-sample filters, sizes as randomize_kernel() draws them
+            if self.hparams["randomize_kernel"]:
+                k_min = int(self.hparams["kernel_size"])
+                kernel_sizes = [2*k + 1 for k in range(k_min, k_min + 4)]
+            else:
+                kernel_sizes = [self.ks]
+            self.batch_rand_conv = BatchRandConv(
+                input_shape[0], kernel_sizes,
+                group_size=self.hparams["randconv_group_size"],
+                identity_prob=self.identity_prob,
+                alpha_range=(float(self.hparams["alpha_min"]), float(self.hparams["alpha_max"]))
+                    if self.hparams["mixing"] else None,
+                clip_min=self.clip_min, clip_max=self.clip_max,
+                # the fixed-size rand_conv above is depthwise
+                depthwise=not self.hparams["randomize_kernel"])
         
 
     def randomize_kernel(self):
@@ -810,17 +990,26 @@ class RandConv_CNN(ERM):
     def rand_conv_module_cuda(self):
         self.rand_conv.to('cuda')       
 
-    def invariant_loss(self, all_x, out):
+    def rand_augment(self, all_x):
+        """A new random-convolution view of `all_x`, clamped to the image
+        range."""
+        if self.hparams["randconv_batched"]:
+            return self.batch_rand_conv(all_x)
         self.randomize()
-        img1=self.randConv_Op(all_x)
-        img1 = torch.clamp(img1, self.clip_min, self.clip_max)
-        output1 = self.predict(img1)
-        
+        return torch.clamp(self.randConv_Op(all_x), self.clip_min, self.clip_max)
+
+    def invariant_views(self, all_x):
+        if self.hparams["randconv_batched"]:
+            # both views in one grouped convolution
+            return self.rand_augment(torch.cat([all_x, all_x])).chunk(2)
+        img1 = self.rand_augment(all_x)
+        # the second view is not clamped, as in the original invariant_loss
+        # (which clamped it into the unused img1); kept to preserve results
         self.randomize()
-        img2=self.randConv_Op(all_x)
-        img1 = torch.clamp(img2, self.clip_min, self.clip_max)
-        output2 = self.predict(img2)
+        img2 = self.randConv_Op(all_x)
+        return img1, img2
 
+    def invariant_loss(self, out, output1, output2):
         p_clean, p_aug1, p_aug2 = F.softmax(
                                 out, dim=1), F.softmax(
                                 output1, dim=1), F.softmax(
@@ -838,40 +1027,36 @@ class RandConv_CNN(ERM):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
         
-        if self.hparams["randomize_kernel"]:
-            self.randomize_kernel()
-        
-        #Trying to add augmix consistency loss here
-        self.randomize()
-        self.rand_conv_module_cuda()
-       
-
-        self.clip_max = self.clip_max.to('cuda')
-        self.clip_min = self.clip_min.to('cuda')
-       
+        if not self.hparams["randconv_batched"]:
+            if self.hparams["randomize_kernel"]:
+                self.randomize_kernel()
+            self.rand_conv_module_cuda()
+            self.clip_max = self.clip_max.to('cuda')
+            self.clip_min = self.clip_min.to('cuda')
 
-        if self.hparams["loss_aug"]:
-            img = self.randConv_Op(all_x)
-            img = torch.clamp(img, self.clip_min, self.clip_max)
-            out = self.predict(img)
-        else:
-            out = self.predict(all_x)
-            
-        loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        views = [self.rand_augment(all_x) if self.hparams["loss_aug"] else all_x]
         if self.hparams["invariant_loss"]:
-            inv_loss = self.invariant_loss(all_x,out)
-            loss += inv_loss*self.hparams["consistency_loss_w"]
-        else:
-            inv_loss= torch.zeros(1)
+            views.extend(self.invariant_views(all_x))
+        with self.forward_pass():
+            outs = self.predict_views(views)
+            out = outs[0]
+            
+            loss = F.cross_entropy(out, all_y)
+            task_loss=loss.detach().clone()
+            if self.hparams["invariant_loss"]:
+                with timing.phase("invariant_loss"):
+                    inv_loss = self.invariant_loss(*outs)
+                loss += inv_loss*self.hparams["consistency_loss_w"]
+            else:
+                inv_loss= torch.zeros(1)
           
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+            correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class RandConv_ViT(ERM_ViT):
 
@@ -889,6 +1074,21 @@ class RandConv_ViT(ERM_ViT):
         
         if not self.hparams["eval"]:
             self.rand_conv =  nn.Conv2d(in_channels=input_shape[0], out_channels=input_shape[0], kernel_size=self.ks,stride=1,padding=self.ks//2,bias=False)
+
+        if self.hparams["randconv_batched"]:
+            # per-sample filters, sizes as randomize_kernel() draws them
+            if self.hparams["randomize_kernel"]:
+                k_min = int(self.hparams["kernel_size"])
+                kernel_sizes = [2*k + 1 for k in range(k_min, k_min + 4)]
+            else:
+                kernel_sizes = [self.ks]
+            self.batch_rand_conv = BatchRandConv(
+                input_shape[0], kernel_sizes,
+                group_size=self.hparams["randconv_group_size"],
+                identity_prob=self.identity_prob,
+                alpha_range=(float(self.hparams["alpha_min"]), float(self.hparams["alpha_max"]))
+                    if self.hparams["mixing"] else None,
+                clip_min=self.clip_min, clip_max=self.clip_max)
         
 
     def randomize_kernel(self):
@@ -925,17 +1125,21 @@ class RandConv_ViT(ERM_ViT):
     def rand_conv_module_cuda(self):
         self.rand_conv.to('cuda')       
 
-    def invariant_loss(self, all_x, out):
+    def rand_augment(self, all_x):
+        """A new random-convolution view of `all_x`, clamped to the image
+        range."""
+        if self.hparams["randconv_batched"]:
+            return self.batch_rand_conv(all_x)
         self.randomize()
-        img1=self.randConv_Op(all_x)
-        img1 = torch.clamp(img1, self.clip_min, self.clip_max)
-        output1 = self.predict(img1)
-        
-        self.randomize()
-        img2=self.randConv_Op(all_x)
-        img2 = torch.clamp(img2, self.clip_min, self.clip_max)
-        output2 = self.predict(img2)
+        return torch.clamp(self.randConv_Op(all_x), self.clip_min, self.clip_max)
+
+    def invariant_views(self, all_x):
+        if self.hparams["randconv_batched"]:
+            # both views in one grouped convolution
+            return self.rand_augment(torch.cat([all_x, all_x])).chunk(2)
+        return self.rand_augment(all_x), self.rand_augment(all_x)
 
+    def invariant_loss(self, out, output1, output2):
         p_clean, p_aug1, p_aug2 = F.softmax(
                                 out, dim=1), F.softmax(
                                 output1, dim=1), F.softmax(
@@ -951,41 +1155,36 @@ class RandConv_ViT(ERM_ViT):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
         
-        if self.hparams["randomize_kernel"]:
-            self.randomize_kernel()
-        
-        #Trying to add augmix consistency loss here
-        self.randomize()
-        self.rand_conv_module_cuda()
-        #img = self.randConv_Op(all_x)
-
-        self.clip_max = self.clip_max.to('cuda')
-        self.clip_min = self.clip_min.to('cuda')
-        # img = torch.clamp(img, self.clip_min, self.clip_max)
-        # out = self.predict(img)
-
-        if self.hparams["loss_aug"]:
-            img = self.randConv_Op(all_x)
-            img = torch.clamp(img, self.clip_min, self.clip_max)
-            out = self.predict(img)
-        else:
-            out = self.predict(all_x)
-            
-        loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        if not self.hparams["randconv_batched"]:
+            if self.hparams["randomize_kernel"]:
+                self.randomize_kernel()
+            self.rand_conv_module_cuda()
+            self.clip_max = self.clip_max.to('cuda')
+            self.clip_min = self.clip_min.to('cuda')
+
+        views = [self.rand_augment(all_x) if self.hparams["loss_aug"] else all_x]
         if self.hparams["invariant_loss"]:
-            inv_loss = self.invariant_loss(all_x,out)
-            loss += inv_loss*float(self.hparams["consistency_loss_w"])
-        else:
-            inv_loss= torch.zeros(1)
+            views.extend(self.invariant_views(all_x))
+        with self.forward_pass():
+            outs = self.predict_views(views)
+            out = outs[0]
+            
+            loss = F.cross_entropy(out, all_y)
+            task_loss=loss.detach().clone()
+            if self.hparams["invariant_loss"]:
+                with timing.phase("invariant_loss"):
+                    inv_loss = self.invariant_loss(*outs)
+                loss += inv_loss*float(self.hparams["consistency_loss_w"])
+            else:
+                inv_loss= torch.zeros(1)
           
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+            correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class AugMix_CNN(ERM):
 
@@ -999,51 +1198,38 @@ class AugMix_CNN(ERM):
         
         self.org_preprocess = transforms.Normalize(hparams["mean_std"][0],hparams["mean_std"][1])
         augmix_augmentations.IMAGE_SIZE = input_shape[1]
+        self.image_size = input_shape[1]
 
-    def aug(self, image):
-        """Perform AugMix augmentations and compute mixture.
-
-        Args:
-            image: PIL.Image input image
-            preprocess: Preprocessing function which should return a torch tensor.
+    def train_env(self, env):
+        if self.hparams['augmix_in_loader']:
+            # AugMix views are generated by the loader workers
+            return augmix_augmentations.AugMixDataset(env, self.hparams,
+                                                      self.image_size)
+        return env
 
-        Returns:
-            mixed: Augmented and mixed image.
-        """
-        aug_list = augmix_augmentations.augmentations
-        if self.hparams["all_ops"]:
-            aug_list = augmix_augmentations.augmentations_all
-
-        ws = np.float32(np.random.dirichlet([1] * self.hparams["mixture_width"]))
-        m = np.float32(np.random.beta(1, 1))
-
-        mix = torch.zeros_like(self.aug_preprocess(image))
-        for i in range(self.hparams["mixture_width"]):
-            image_aug = image.copy()
-            depth = self.hparams["mixture_depth"] if self.hparams["mixture_depth"] > 0 else np.random.randint(
-                1, 4)
-            for _ in range(depth):
-                op = np.random.choice(aug_list)
-                image_aug = op(image_aug, self.hparams["aug_severity"])
-            # Preprocessing commutes since all coefficients are convex
-            mix += ws[i] * self.aug_preprocess(image_aug)
-
-        mixed = (1 - m) * self.aug_preprocess(image) + m * mix
-        return mixed
+    def aug(self, image):
+        """Perform AugMix augmentations on a PIL image and compute mixture."""
+        return augmix_augmentations.augment_and_mix(image, self.aug_preprocess,
+                                                    self.hparams)
     
-    def divergence_loss(self, all_x, out):
-
+    def augmented_views(self, all_x):
+        """Two AugMix views of `all_x`, batched on the device
+        (hparams['augmix_batched']) or per image with PIL."""
+        if self.hparams["augmix_batched"]:
+            return (self.org_preprocess(augmix_batch.augment_and_mix(all_x, self.hparams)),
+                    self.org_preprocess(augmix_batch.augment_and_mix(all_x, self.hparams)))
         aug_x_1, aug_x_2 = [], []
         for img in torch.split(all_x,1,dim=0):
             aug_x_1.append(self.aug(transforms.ToPILImage()(img.squeeze(0))))
             aug_x_2.append(self.aug(transforms.ToPILImage()(img.squeeze(0))))
+        return torch.stack(aug_x_1,dim=0).to(all_x.device), torch.stack(aug_x_2,dim=0).to(all_x.device)
 
-        aug_x_1, aug_x_2 = torch.stack(aug_x_1,dim=0).to(torch.device('cuda')),torch.stack(aug_x_2,dim=0).to(torch.device('cuda'))
-
+    def divergence_loss(self, out, out_aug1, out_aug2):
+        """Jensen-Shannon consistency loss."""
         p_clean, p_aug1, p_aug2 = F.softmax(
           out, dim=1), F.softmax(
-              self.predict(aug_x_1), dim=1), F.softmax(
-                  self.predict(aug_x_2), dim=1)
+              out_aug1, dim=1), F.softmax(
+                  out_aug2, dim=1)
         
         p_mixture = torch.clamp((p_clean + p_aug1 + p_aug2) / 3., 1e-7, 1).log()
         inv_loss = (F.kl_div(p_mixture, p_clean, reduction='batchmean') +
@@ -1055,24 +1241,30 @@ class AugMix_CNN(ERM):
     def update(self, minibatches, unlabeled=None):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-    
-        out = self.predict(self.org_preprocess(all_x))
-        loss = F.cross_entropy(out, all_y)
+        if all_x.dim() == 5:
+            # preprocessed (clean, aug1, aug2) triples from AugMixDataset
+            views = all_x.unbind(1)
+        else:
+            views = (self.org_preprocess(all_x),) + tuple(self.augmented_views(all_x))
+        with self.forward_pass():
+            out, out_aug1, out_aug2 = self.predict_views(views)
+            loss = F.cross_entropy(out, all_y)
 
-        inv_loss = self.divergence_loss(all_x,out)
+            with timing.phase("invariant_loss"):
+                inv_loss = self.divergence_loss(out, out_aug1, out_aug2)
         
-        task_loss = loss.item()
-        loss += inv_loss*self.hparams["consistency_loss_w"]
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()
+            task_loss = loss.detach().clone()
+            loss += inv_loss*self.hparams["consistency_loss_w"]
+            correct = (out.argmax(1).eq(all_y).float()).sum()
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         if self.hparams['scheduler']:
             self.scheduler.step()
 
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class AugMix_ViT(ERM_ViT):
 
@@ -1086,52 +1278,38 @@ class AugMix_ViT(ERM_ViT):
         
         self.org_preprocess = transforms.Normalize(hparams["mean_std"][0],hparams["mean_std"][1])
         augmix_augmentations.IMAGE_SIZE = input_shape[1]
+        self.image_size = input_shape[1]
 
-    def aug(self, image):
-        """Perform AugMix augmentations and compute mixture.
-
-        Args:
-            image: PIL.Image input image
-            preprocess: Preprocessing function which should return a torch tensor.
+    def train_env(self, env):
+        if self.hparams['augmix_in_loader']:
+            # AugMix views are generated by the loader workers
+            return augmix_augmentations.AugMixDataset(env, self.hparams,
+                                                      self.image_size)
+        return env
 
-        Returns:
-            mixed: Augmented and mixed image.
-        """
-        aug_list = augmix_augmentations.augmentations
-        if self.hparams["all_ops"]:
-            aug_list = augmix_augmentations.augmentations_all
-
-        ws = np.float32(np.random.dirichlet([1] * self.hparams["mixture_width"]))
-        m = np.float32(np.random.beta(1, 1))
-
-        mix = torch.zeros_like(self.aug_preprocess(image))
-        for i in range(self.hparams["mixture_width"]):
-            image_aug = image.copy()
-            depth = self.hparams["mixture_depth"] if self.hparams["mixture_depth"] > 0 else np.random.randint(
-                1, 4)
-            for _ in range(depth):
-                op = np.random.choice(aug_list)
-                image_aug = op(image_aug, self.hparams["aug_severity"])
-            # Preprocessing commutes since all coefficients are convex
-            # print("+++++++ Size mix ",mix.size()," ws ",ws[i], " aug_preprocess(image_aug) ",self.aug_preprocess(image_aug).size())
-            mix += ws[i] * self.aug_preprocess(image_aug)
-
-        mixed = (1 - m) * self.aug_preprocess(image) + m * mix
-        return mixed
+    def aug(self, image):
+        """Perform AugMix augmentations on a PIL image and compute mixture."""
+        return augmix_augmentations.augment_and_mix(image, self.aug_preprocess,
+                                                    self.hparams)
     
-    def divergence_loss(self, all_x, out):
-
+    def augmented_views(self, all_x):
+        """Two AugMix views of `all_x`, batched on the device
+        (hparams['augmix_batched']) or per image with PIL."""
+        if self.hparams["augmix_batched"]:
+            return (self.org_preprocess(augmix_batch.augment_and_mix(all_x, self.hparams)),
+                    self.org_preprocess(augmix_batch.augment_and_mix(all_x, self.hparams)))
         aug_x_1, aug_x_2 = [], []
         for img in torch.split(all_x,1,dim=0):
             aug_x_1.append(self.aug(transforms.ToPILImage()(img.squeeze(0))))
             aug_x_2.append(self.aug(transforms.ToPILImage()(img.squeeze(0))))
+        return torch.stack(aug_x_1,dim=0).to(all_x.device), torch.stack(aug_x_2,dim=0).to(all_x.device)
 
-        aug_x_1, aug_x_2 = torch.stack(aug_x_1,dim=0).to(torch.device('cuda')),torch.stack(aug_x_2,dim=0).to(torch.device('cuda'))
-
+    def divergence_loss(self, out, out_aug1, out_aug2):
+        """Jensen-Shannon consistency loss."""
         p_clean, p_aug1, p_aug2 = F.softmax(
           out, dim=1), F.softmax(
-              self.predict(aug_x_1), dim=1), F.softmax(
-                  self.predict(aug_x_2), dim=1)
+              out_aug1, dim=1), F.softmax(
+                  out_aug2, dim=1)
         
         p_mixture = torch.clamp((p_clean + p_aug1 + p_aug2) / 3., 1e-7, 1).log()
         inv_loss = (F.kl_div(p_mixture, p_clean, reduction='batchmean') +
@@ -1143,24 +1321,30 @@ class AugMix_ViT(ERM_ViT):
     def update(self, minibatches, unlabeled=None):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-    
-        out = self.predict(self.org_preprocess(all_x))
-        loss = F.cross_entropy(out, all_y)
+        if all_x.dim() == 5:
+            # preprocessed (clean, aug1, aug2) triples from AugMixDataset
+            views = all_x.unbind(1)
+        else:
+            views = (self.org_preprocess(all_x),) + tuple(self.augmented_views(all_x))
+        with self.forward_pass():
+            out, out_aug1, out_aug2 = self.predict_views(views)
+            loss = F.cross_entropy(out, all_y)
 
-        inv_loss = self.divergence_loss(all_x,out)
+            with timing.phase("invariant_loss"):
+                inv_loss = self.divergence_loss(out, out_aug1, out_aug2)
         
-        task_loss = loss.item()
-        loss += inv_loss*self.hparams["consistency_loss_w"]
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()
+            task_loss = loss.detach().clone()
+            loss += inv_loss*self.hparams["consistency_loss_w"]
+            correct = (out.argmax(1).eq(all_y).float()).sum()
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         if self.hparams['scheduler']:
             self.scheduler.step()
 
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class ME_ADA_CNN(ERM):
 
@@ -1389,7 +1573,71 @@ class ADA_ViT(ERM_ViT):
 
         return inputs_max, targets
 
+def _adversarial_schedule(algorithm):
+    """
+    Schedule of the ABA/ALT adversarial inner loop. The augmenter is
+    re-initialized every hparams['adv_refresh_every'] (K) training steps
+    (only at the first step with hparams['adv_warm_start']) and the
+    hparams['adv_steps'] inner steps are spread over the K steps, so the
+    augmenter keeps training from its previous state in between. Returns
+    whether to re-initialize now and the number of inner steps to run.
+    """
+    hparams = algorithm.hparams
+    every = hparams['adv_refresh_every']
+    calls = algorithm.adv_calls
+    algorithm.adv_calls += 1
+    refresh = calls == 0 or (not hparams['adv_warm_start'] and calls % every == 0)
+    return refresh, -(-hparams['adv_steps'] // every)
+
+
+@contextlib.contextmanager
+def _frozen_backbone(algorithm):
+    """With hparams['adv_frozen_backbone'], disable the gradients of the
+    network parameters, so the inner loop only backpropagates to the
+    augmenter."""
+    params = []
+    if algorithm.hparams['adv_frozen_backbone']:
+        params = [p for p in algorithm.network.parameters() if p.requires_grad]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+
+def _augmenter_modules(augmenter):
+    # Multi_BNN keeps its blocks in a plain list, which state_dict() misses
+    return [augmenter] + list(augmenter.blocks)
+
+
+def _adversarial_training_state(algorithm, state, augmenter):
+    """Add the position in the adversarial schedule and the augmenter
+    weights (which the schedule keeps training across steps) to a training
+    state."""
+    state['adv_calls'] = algorithm.adv_calls
+    state['augmenter'] = [
+        {'state_dict': module.state_dict(),
+         'alphas': {name: sub.alpha for name, sub in module.named_modules()
+                    if hasattr(sub, 'alpha')}}
+        for module in _augmenter_modules(augmenter)]
+    return state
+
+
+def _load_adversarial_training_state(algorithm, state, augmenter):
+    algorithm.adv_calls = state.get('adv_calls', 0)
+    for module, module_state in zip(_augmenter_modules(augmenter),
+                                    state.get('augmenter', [])):
+        module.load_state_dict(module_state['state_dict'])
+        for name, sub in module.named_modules():
+            if name in module_state['alphas']:
+                sub.alpha = module_state['alphas'][name]
+
+
 class ABA_CNN(ERM):
+    SUPPORTS_AMP = False  # inner augmentation optimizer
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ABA_CNN, self).__init__(input_shape, num_classes, num_domains,
                                     hparams)
@@ -1400,34 +1648,45 @@ class ABA_CNN(ERM):
     
         #self.aug_optimizer = torch.optim.SGD(self.bcnn_module.parameters(),self.hparams["lr_adv"])
         self.aug_optimizer = torch.optim.Adam(self.bcnn_module.parameters(),self.hparams["lr_adv"])
+        self.adv_calls = 0
         
     
+    def training_state_dict(self):
+        state = super(ABA_CNN, self).training_state_dict()
+        return _adversarial_training_state(self, state, self.bcnn_module)
+
+    def load_training_state_dict(self, state):
+        super(ABA_CNN, self).load_training_state_dict(state)
+        _load_adversarial_training_state(self, state, self.bcnn_module)
+
     def bcnn_module_cuda(self):
         self.bcnn_module.to('cuda')
 
     def augmentation_process(self,all_x,all_y,out):
         self.network.eval()
-        self.bcnn_module.randomize()
+        refresh, n_inner = _adversarial_schedule(self)
+        if refresh:
+            self.bcnn_module.randomize()
         #self.bcnn_module_cuda()
         self.bcnn_module.train()
-        for n in range(self.hparams["adv_steps"]):
-            self.network.zero_grad()
-            self.aug_optimizer.zero_grad()
-            self.bcnn_module.zero_grad()
+        with _frozen_backbone(self):
+            for n in range(n_inner):
+                self.network.zero_grad()
+                self.aug_optimizer.zero_grad()
+                self.bcnn_module.zero_grad()
 
-            x_g, bnn_kl = self.bcnn_module(all_x)
-            y_g = self.predict(x_g)
+                x_g, bnn_kl = self.bcnn_module(all_x)
+                y_g = self.predict(x_g)
 
-            loss_aug = -F.cross_entropy(y_g, all_y) - self.hparams["elbo_beta"] * bnn_kl
-            loss_aug.backward()
-            self.aug_optimizer.step()
+                loss_aug = -F.cross_entropy(y_g, all_y) - self.hparams["elbo_beta"] * bnn_kl
+                loss_aug.backward()
+                self.aug_optimizer.step()
         
         x_r,_ = self.bcnn_module(all_x)
         x_g,_ = self.bcnn_module(all_x)
 
         #### consistency loss
-        outs_r = self.predict(x_r) 
-        outs_g = self.predict(x_g)
+        outs_r, outs_g = self.predict_views([x_r, x_g])
 
         p_clean = F.softmax(out, dim=1)
         p_aug1 = F.softmax(outs_r, dim=1)
@@ -1450,13 +1709,15 @@ class ABA_CNN(ERM):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        out = self.predict(all_x)    
+        with self.forward_pass():
+            out = self.predict(all_x)
         loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        task_loss=loss.detach().clone()
 
         if self.hparams["epoch"] >= self.hparams["pre_epoch"]:
         
-            inv_loss = self.augmentation_process(all_x,all_y,out)
+            with timing.phase("adversarial_augmentation"):
+                inv_loss = self.augmentation_process(all_x,all_y,out)
             loss = (1-self.hparams["clw"])*loss + self.hparams["clw"]*inv_loss
 
             self.bcnn_module.eval()
@@ -1464,16 +1725,18 @@ class ABA_CNN(ERM):
         else:
             inv_loss= torch.zeros(1)
        
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+        correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
         self.network.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class ABA_ViT(ERM_ViT):
+    SUPPORTS_AMP = False  # inner augmentation optimizer
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ABA_ViT, self).__init__(input_shape, num_classes, num_domains,
                                     hparams)
@@ -1484,34 +1747,45 @@ class ABA_ViT(ERM_ViT):
     
         #self.aug_optimizer = torch.optim.SGD(self.bcnn_module.parameters(),self.hparams["lr_adv"])
         self.aug_optimizer = torch.optim.Adam(self.bcnn_module.parameters(),self.hparams["lr_adv"])
+        self.adv_calls = 0
         
     
+    def training_state_dict(self):
+        state = super(ABA_ViT, self).training_state_dict()
+        return _adversarial_training_state(self, state, self.bcnn_module)
+
+    def load_training_state_dict(self, state):
+        super(ABA_ViT, self).load_training_state_dict(state)
+        _load_adversarial_training_state(self, state, self.bcnn_module)
+
     def bcnn_module_cuda(self):
         self.bcnn_module.to('cuda')
 
     def augmentation_process(self,all_x,all_y,out):
         self.network.eval()
-        self.bcnn_module.randomize()
+        refresh, n_inner = _adversarial_schedule(self)
+        if refresh:
+            self.bcnn_module.randomize()
         #self.bcnn_module_cuda()
         self.bcnn_module.train()
-        for n in range(self.hparams["adv_steps"]):
-            self.network.zero_grad()
-            self.aug_optimizer.zero_grad()
-            self.bcnn_module.zero_grad()
+        with _frozen_backbone(self):
+            for n in range(n_inner):
+                self.network.zero_grad()
+                self.aug_optimizer.zero_grad()
+                self.bcnn_module.zero_grad()
 
-            x_g, bnn_kl = self.bcnn_module(all_x)
-            y_g = self.predict(x_g)
+                x_g, bnn_kl = self.bcnn_module(all_x)
+                y_g = self.predict(x_g)
 
-            loss_aug = -F.cross_entropy(y_g, all_y) - self.hparams["elbo_beta"] * bnn_kl
-            loss_aug.backward()
-            self.aug_optimizer.step()
+                loss_aug = -F.cross_entropy(y_g, all_y) - self.hparams["elbo_beta"] * bnn_kl
+                loss_aug.backward()
+                self.aug_optimizer.step()
         
         x_r,_ = self.bcnn_module(all_x)
         x_g,_ = self.bcnn_module(all_x)
 
         #### consistency loss
-        outs_r = self.predict(x_r) 
-        outs_g = self.predict(x_g)
+        outs_r, outs_g = self.predict_views([x_r, x_g])
 
         p_clean = F.softmax(out, dim=1)
         p_aug1 = F.softmax(outs_r, dim=1)
@@ -1534,13 +1808,15 @@ class ABA_ViT(ERM_ViT):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        out = self.predict(all_x)    
+        with self.forward_pass():
+            out = self.predict(all_x)
         loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        task_loss=loss.detach().clone()
 
         if self.hparams["epoch"] >= self.hparams["pre_epoch"]:
         
-            inv_loss = self.augmentation_process(all_x,all_y,out)
+            with timing.phase("adversarial_augmentation"):
+                inv_loss = self.augmentation_process(all_x,all_y,out)
             loss = (1-self.hparams["clw"])*loss + self.hparams["clw"]*inv_loss
 
             self.bcnn_module.eval()
@@ -1548,16 +1824,18 @@ class ABA_ViT(ERM_ViT):
         else:
             inv_loss= torch.zeros(1)
        
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+        correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
         self.network.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}  
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}  
 
 class ALT_CNN(ERM):
+    SUPPORTS_AMP = False  # inner augmentation optimizer
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ALT_CNN, self).__init__(input_shape, num_classes, num_domains,
                                     hparams)
@@ -1568,8 +1846,17 @@ class ALT_CNN(ERM):
                 a=hparams["alpha_init"]
                 )
         self.aug_optimizer = torch.optim.Adam(self.trans_module.parameters(),self.hparams["lr_adv"])
+        self.adv_calls = 0
         self.tv_loss = TVLoss()
         
+    def training_state_dict(self):
+        state = super(ALT_CNN, self).training_state_dict()
+        return _adversarial_training_state(self, state, self.trans_module)
+
+    def load_training_state_dict(self, state):
+        super(ALT_CNN, self).load_training_state_dict(state)
+        _load_adversarial_training_state(self, state, self.trans_module)
+
     def init_weights(self, m):
         if type(m) == nn.Conv2d:
             nn.init.kaiming_normal_(m.weight.data)
@@ -1577,26 +1864,27 @@ class ALT_CNN(ERM):
     def augmentation_process(self,all_x,all_y,out):
         self.network.eval()
         self.trans_module.train()
-        self.trans_module.apply(self.init_weights)
-        
-        for n in range(self.hparams["adv_steps"]):
-            self.network.zero_grad()
-            self.aug_optimizer.zero_grad()
-            self.trans_module.zero_grad()
-
-            x_g = self.trans_module(all_x)
-            y_g = self.predict(x_g)
-
-            loss_aug = -F.cross_entropy(y_g, all_y) + self.tv_loss(x_g)
-            loss_aug.backward()
-            self.aug_optimizer.step()
+        refresh, n_inner = _adversarial_schedule(self)
+        if refresh:
+            self.trans_module.apply(self.init_weights)
+        with _frozen_backbone(self):
+            for n in range(n_inner):
+                self.network.zero_grad()
+                self.aug_optimizer.zero_grad()
+                self.trans_module.zero_grad()
+
+                x_g = self.trans_module(all_x)
+                y_g = self.predict(x_g)
+
+                loss_aug = -F.cross_entropy(y_g, all_y) + self.tv_loss(x_g)
+                loss_aug.backward()
+                self.aug_optimizer.step()
         
         x_r = self.trans_module(all_x)
         x_g = self.trans_module(all_x)
 
         #### consistency loss
-        outs_r = self.predict(x_r) 
-        outs_g = self.predict(x_g)
+        outs_r, outs_g = self.predict_views([x_r, x_g])
 
         p_clean = F.softmax(out, dim=1)
         p_aug1 = F.softmax(outs_r, dim=1)
@@ -1618,13 +1906,15 @@ class ALT_CNN(ERM):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        out = self.predict(all_x)    
+        with self.forward_pass():
+            out = self.predict(all_x)
         loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        task_loss=loss.detach().clone()
 
         if self.hparams["epoch"] >= self.hparams["pre_epoch"]:
         
-            inv_loss = self.augmentation_process(all_x,all_y,out)
+            with timing.phase("adversarial_augmentation"):
+                inv_loss = self.augmentation_process(all_x,all_y,out)
             loss = (1-self.hparams["clw"])*loss + self.hparams["clw"]*inv_loss
 
             self.trans_module.eval()
@@ -1632,15 +1922,17 @@ class ALT_CNN(ERM):
         else:
             inv_loss= torch.zeros(1)
        
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+        correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 class ALT_ViT(ERM_ViT):
+    SUPPORTS_AMP = False  # inner augmentation optimizer
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ALT_ViT, self).__init__(input_shape, num_classes, num_domains,
                                     hparams)
@@ -1651,8 +1943,17 @@ class ALT_ViT(ERM_ViT):
                 a=hparams["alpha_init"]
                 )
         self.aug_optimizer = torch.optim.Adam(self.trans_module.parameters(),self.hparams["lr_adv"])
+        self.adv_calls = 0
         self.tv_loss = TVLoss()
         
+    def training_state_dict(self):
+        state = super(ALT_ViT, self).training_state_dict()
+        return _adversarial_training_state(self, state, self.trans_module)
+
+    def load_training_state_dict(self, state):
+        super(ALT_ViT, self).load_training_state_dict(state)
+        _load_adversarial_training_state(self, state, self.trans_module)
+
     def init_weights(self, m):
         if type(m) == nn.Conv2d:
             nn.init.kaiming_normal_(m.weight.data)
@@ -1660,26 +1961,27 @@ class ALT_ViT(ERM_ViT):
     def augmentation_process(self,all_x,all_y,out):
         self.network.eval()
         self.trans_module.train()
-        self.trans_module.apply(self.init_weights)
-        
-        for n in range(self.hparams["adv_steps"]):
-            self.network.zero_grad()
-            self.aug_optimizer.zero_grad()
-            self.trans_module.zero_grad()
-
-            x_g = self.trans_module(all_x)
-            y_g = self.predict(x_g)
-
-            loss_aug = -F.cross_entropy(y_g, all_y) + self.tv_loss(x_g)
-            loss_aug.backward()
-            self.aug_optimizer.step()
+        refresh, n_inner = _adversarial_schedule(self)
+        if refresh:
+            self.trans_module.apply(self.init_weights)
+        with _frozen_backbone(self):
+            for n in range(n_inner):
+                self.network.zero_grad()
+                self.aug_optimizer.zero_grad()
+                self.trans_module.zero_grad()
+
+                x_g = self.trans_module(all_x)
+                y_g = self.predict(x_g)
+
+                loss_aug = -F.cross_entropy(y_g, all_y) + self.tv_loss(x_g)
+                loss_aug.backward()
+                self.aug_optimizer.step()
         
         x_r = self.trans_module(all_x)
         x_g = self.trans_module(all_x)
 
         #### consistency loss
-        outs_r = self.predict(x_r) 
-        outs_g = self.predict(x_g)
+        outs_r, outs_g = self.predict_views([x_r, x_g])
 
         p_clean = F.softmax(out, dim=1)
         p_aug1 = F.softmax(outs_r, dim=1)
@@ -1701,13 +2003,15 @@ class ALT_ViT(ERM_ViT):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        out = self.predict(all_x)    
+        with self.forward_pass():
+            out = self.predict(all_x)
         loss = F.cross_entropy(out, all_y)
-        task_loss=loss.item()
+        task_loss=loss.detach().clone()
 
         if self.hparams["epoch"] >= self.hparams["pre_epoch"]:
         
-            inv_loss = self.augmentation_process(all_x,all_y,out)
+            with timing.phase("adversarial_augmentation"):
+                inv_loss = self.augmentation_process(all_x,all_y,out)
             loss = (1-self.hparams["clw"])*loss + self.hparams["clw"]*inv_loss
 
             self.trans_module.eval()
@@ -1715,13 +2019,13 @@ class ALT_ViT(ERM_ViT):
         else:
             inv_loss= torch.zeros(1)
        
-        correct = (out.argmax(1).eq(all_y).float()).sum().item()  
+        correct = (out.argmax(1).eq(all_y).float()).sum()  
         
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
         
-        return {'loss': loss.item(),'task_loss': task_loss, 'inv_loss':inv_loss.item(), 'train_acc':correct/torch.ones(len(all_x)).sum().item()}    
+        return {'loss': loss.detach(),'task_loss': task_loss, 'inv_loss':inv_loss.detach(), 'train_acc': correct / len(all_x)}    
 
 
 class Mixup(ERM):
@@ -1736,25 +2040,26 @@ class Mixup(ERM):
                                     hparams)
 
     def update(self, minibatches, unlabeled=None):
-        objective = 0
+        with self.forward_pass():
+            objective = 0
 
-        for (xi, yi), (xj, yj) in random_pairs_of_minibatches(minibatches):
-            lam = np.random.beta(self.hparams["mixup_alpha"],
-                                 self.hparams["mixup_alpha"])
+            for (xi, yi), (xj, yj) in random_pairs_of_minibatches(minibatches):
+                lam = np.random.beta(self.hparams["mixup_alpha"],
+                                     self.hparams["mixup_alpha"])
 
-            x = lam * xi + (1 - lam) * xj
-            predictions = self.predict(x)
+                x = lam * xi + (1 - lam) * xj
+                predictions = self.predict(x)
 
-            objective += lam * F.cross_entropy(predictions, yi)
-            objective += (1 - lam) * F.cross_entropy(predictions, yj)
+                objective += lam * F.cross_entropy(predictions, yi)
+                objective += (1 - lam) * F.cross_entropy(predictions, yj)
 
-        objective /= len(minibatches)
+            objective /= len(minibatches)
 
         self.optimizer.zero_grad()
-        objective.backward()
-        self.optimizer.step()
+        self.backward(objective)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': objective.item()}
+        return {'loss': objective.detach()}
 
 class GroupDRO(ERM):
     """
@@ -1775,20 +2080,21 @@ class GroupDRO(ERM):
 
         losses = torch.zeros(len(minibatches)).to(device)
 
-        for m in range(len(minibatches)):
-            x, y = minibatches[m]
-            losses[m] = F.cross_entropy(self.predict(x), y)
-            self.q[m] *= (self.hparams["groupdro_eta"] * losses[m].data).exp()
+        with self.forward_pass():
+            for m in range(len(minibatches)):
+                x, y = minibatches[m]
+                losses[m] = F.cross_entropy(self.predict(x), y)
+                self.q[m] *= (self.hparams["groupdro_eta"] * losses[m].data).exp()
 
-        self.q /= self.q.sum()
+            self.q /= self.q.sum()
 
-        loss = torch.dot(losses, self.q)
+            loss = torch.dot(losses, self.q)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 class MLDG(ERM):
     """
@@ -1798,6 +2104,10 @@ class MLDG(ERM):
     Related: https://arxiv.org/pdf/1910.13580.pdf
     """
 
+    SUPPORTS_AMP = False  # meta-gradients accumulated by hand
+    # the compiled forward would not follow copy.deepcopy(self.network)
+    SUPPORTS_COMPILE = False
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(MLDG, self).__init__(input_shape, num_classes, num_domains,
                                    hparams)
@@ -1850,7 +2160,7 @@ class MLDG(ERM):
                     p_tgt.grad.data.add_(p_src.grad.data / num_mb)
 
             # `objective` is populated for reporting purposes
-            objective += inner_obj.item()
+            objective += inner_obj.detach()
 
             # this computes Gj on the clone-network
             loss_inner_j = F.cross_entropy(inner_net(xj), yj)
@@ -1858,7 +2168,7 @@ class MLDG(ERM):
                                          allow_unused=True)
 
             # `objective` is populated for reporting purposes
-            objective += (self.hparams['mldg_beta'] * loss_inner_j).item()
+            objective += (self.hparams['mldg_beta'] * loss_inner_j).detach()
 
             for p, g_j in zip(self.network.parameters(), grad_inner_j):
                 if g_j is not None:
@@ -1961,27 +2271,28 @@ class AbstractMMD(ERM):
         penalty = 0
         nmb = len(minibatches)
 
-        features = [self.featurizer(xi) for xi, _ in minibatches]
-        classifs = [self.classifier(fi) for fi in features]
-        targets = [yi for _, yi in minibatches]
+        with self.forward_pass():
+            features = [self.featurizer(xi) for xi, _ in minibatches]
+            classifs = [self.classifier(fi) for fi in features]
+            targets = [yi for _, yi in minibatches]
 
-        for i in range(nmb):
-            objective += F.cross_entropy(classifs[i], targets[i])
-            for j in range(i + 1, nmb):
-                penalty += self.mmd(features[i], features[j])
+            for i in range(nmb):
+                objective += F.cross_entropy(classifs[i], targets[i])
+                for j in range(i + 1, nmb):
+                    penalty += self.mmd(features[i], features[j])
 
-        objective /= nmb
-        if nmb > 1:
-            penalty /= (nmb * (nmb - 1) / 2)
+            objective /= nmb
+            if nmb > 1:
+                penalty /= (nmb * (nmb - 1) / 2)
 
         self.optimizer.zero_grad()
-        (objective + (self.hparams['mmd_gamma'] * penalty)).backward()
-        self.optimizer.step()
+        self.backward(objective + (self.hparams['mmd_gamma'] * penalty))
+        self.optimizer_step(self.optimizer)
 
         if torch.is_tensor(penalty):
-            penalty = penalty.item()
+            penalty = penalty.detach()
 
-        return {'loss': objective.item(), 'penalty': penalty}
+        return {'loss': objective.detach(), 'penalty': penalty}
 
 class MMD(AbstractMMD):
     """
@@ -2030,15 +2341,16 @@ class MTL(Algorithm):
         self.ema = self.hparams['mtl_ema']
 
     def update(self, minibatches, unlabeled=None):
-        loss = 0
-        for env, (x, y) in enumerate(minibatches):
-            loss += F.cross_entropy(self.predict(x, env), y)
+        with self.forward_pass():
+            loss = 0
+            for env, (x, y) in enumerate(minibatches):
+                loss += F.cross_entropy(self.predict(x, env), y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def update_embeddings_(self, features, env=None):
         return_embedding = features.mean(0)
@@ -2062,6 +2374,8 @@ class SagNet(Algorithm):
     Algorithm 1 from: https://arxiv.org/abs/1910.11645
     """
 
+    SUPPORTS_AMP = False  # three optimizers stepped in one update
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(SagNet, self).__init__(input_shape, num_classes, num_domains,
                                      hparams)
@@ -2171,8 +2485,8 @@ class SagNet(Algorithm):
         loss_adv.backward()
         self.optimizer_f.step()
 
-        return {'loss_c': loss_c.item(), 'loss_s': loss_s.item(),
-                'loss_adv': loss_adv.item()}
+        return {'loss_c': loss_c.detach(), 'loss_s': loss_s.detach(),
+                'loss_adv': loss_adv.detach()}
 
     def predict(self, x):
         return self.network_c(self.network_f(x))
@@ -2183,6 +2497,8 @@ class SagNet_ViT(Algorithm):
     Algorithm 1 from: https://arxiv.org/abs/1910.11645
     """
 
+    SUPPORTS_AMP = False  # three optimizers stepped in one update
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(SagNet_ViT, self).__init__(input_shape, num_classes, num_domains,
                                      hparams)
@@ -2300,13 +2616,15 @@ class SagNet_ViT(Algorithm):
         loss_adv.backward()
         self.optimizer_f.step()
 
-        return {'loss_c': loss_c.item(), 'loss_s': loss_s.item(),
-                'loss_adv': loss_adv.item()}
+        return {'loss_c': loss_c.detach(), 'loss_s': loss_s.detach(),
+                'loss_adv': loss_adv.detach()}
 
     def predict(self, x):
         return self.network_c(self.predict_transformer(x))
 
 class RSC(ERM):
+    SUPPORTS_AMP = False  # feature gradients used to build the masks
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(RSC, self).__init__(input_shape, num_classes, num_domains,
                                   hparams)
@@ -2357,10 +2675,10 @@ class RSC(ERM):
         # Equation (5): update
         loss = F.cross_entropy(all_p_muted_again, all_y)
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 class SD(ERM):
     """
@@ -2376,17 +2694,18 @@ class SD(ERM):
     def update(self, minibatches, unlabeled=None):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-        all_p = self.predict(all_x)
+        with self.forward_pass():
+            all_p = self.predict(all_x)
 
-        loss = F.cross_entropy(all_p, all_y)
-        penalty = (all_p ** 2).mean()
-        objective = loss + self.sd_reg * penalty
+            loss = F.cross_entropy(all_p, all_y)
+            penalty = (all_p ** 2).mean()
+            objective = loss + self.sd_reg * penalty
 
         self.optimizer.zero_grad()
-        objective.backward()
-        self.optimizer.step()
+        self.backward(objective)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item(), 'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'penalty': penalty.detach()}
 
 class ANDMask(ERM):
     """
@@ -2394,6 +2713,8 @@ class ANDMask(ERM):
     AND-Mask implementation from [https://github.com/gibipara92/learning-explanations-hard-to-vary]
     """
 
+    SUPPORTS_AMP = False  # per-environment gradients combined by hand
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ANDMask, self).__init__(input_shape, num_classes, num_domains, hparams)
 
@@ -2406,7 +2727,7 @@ class ANDMask(ERM):
             logits = self.network(x)
 
             env_loss = F.cross_entropy(logits, y)
-            mean_loss += env_loss.item() / len(minibatches)
+            mean_loss += env_loss.detach() / len(minibatches)
 
             env_grads = autograd.grad(env_loss, self.network.parameters())
             for grads, env_grad in zip(param_gradients, env_grads):
@@ -2439,6 +2760,8 @@ class IGA(ERM):
     From https://arxiv.org/abs/2008.01883v2
     """
 
+    SUPPORTS_AMP = False  # gradient penalty (create_graph)
+
     def __init__(self, in_features, num_classes, num_domains, hparams):
         super(IGA, self).__init__(in_features, num_classes, num_domains, hparams)
 
@@ -2472,7 +2795,7 @@ class IGA(ERM):
         objective.backward()
         self.optimizer.step()
 
-        return {'loss': mean_loss.item(), 'penalty': penalty_value.item()}
+        return {'loss': mean_loss.detach(), 'penalty': penalty_value.detach()}
 
 class SelfReg(ERM):
     def __init__(self, input_shape, num_classes, num_domains, hparams):
@@ -2521,46 +2844,47 @@ class SelfReg(ERM):
             all_x = sorted_x
             all_y = sorted_y
 
-        feat = self.featurizer(all_x)
-        proj = self.cdpl(feat)
-
-        output = self.classifier(feat)
-
-        # shuffle
-        output_2 = torch.zeros_like(output)
-        feat_2 = torch.zeros_like(proj)
-        output_3 = torch.zeros_like(output)
-        feat_3 = torch.zeros_like(proj)
-        ex = 0
-        for end in intervals:
-            shuffle_indices = torch.randperm(end - ex) + ex
-            shuffle_indices2 = torch.randperm(end - ex) + ex
-            for idx in range(end - ex):
-                output_2[idx + ex] = output[shuffle_indices[idx]]
-                feat_2[idx + ex] = proj[shuffle_indices[idx]]
-                output_3[idx + ex] = output[shuffle_indices2[idx]]
-                feat_3[idx + ex] = proj[shuffle_indices2[idx]]
-            ex = end
-
-        # mixup
-        output_3 = lam * output_2 + (1 - lam) * output_3
-        feat_3 = lam * feat_2 + (1 - lam) * feat_3
-
-        # regularization
-        L_ind_logit = self.MSEloss(output, output_2)
-        L_hdl_logit = self.MSEloss(output, output_3)
-        L_ind_feat = 0.3 * self.MSEloss(feat, feat_2)
-        L_hdl_feat = 0.3 * self.MSEloss(feat, feat_3)
-
-        cl_loss = F.cross_entropy(output, all_y)
-        C_scale = min(cl_loss.item(), 1.)
-        loss = cl_loss + C_scale * (lam * (L_ind_logit + L_ind_feat) + (1 - lam) * (L_hdl_logit + L_hdl_feat))
+        with self.forward_pass():
+            feat = self.featurizer(all_x)
+            proj = self.cdpl(feat)
+
+            output = self.classifier(feat)
+
+            # shuffle
+            output_2 = torch.zeros_like(output)
+            feat_2 = torch.zeros_like(proj)
+            output_3 = torch.zeros_like(output)
+            feat_3 = torch.zeros_like(proj)
+            ex = 0
+            for end in intervals:
+                shuffle_indices = torch.randperm(end - ex) + ex
+                shuffle_indices2 = torch.randperm(end - ex) + ex
+                for idx in range(end - ex):
+                    output_2[idx + ex] = output[shuffle_indices[idx]]
+                    feat_2[idx + ex] = proj[shuffle_indices[idx]]
+                    output_3[idx + ex] = output[shuffle_indices2[idx]]
+                    feat_3[idx + ex] = proj[shuffle_indices2[idx]]
+                ex = end
+
+            # mixup
+            output_3 = lam * output_2 + (1 - lam) * output_3
+            feat_3 = lam * feat_2 + (1 - lam) * feat_3
+
+            # regularization
+            L_ind_logit = self.MSEloss(output, output_2)
+            L_hdl_logit = self.MSEloss(output, output_3)
+            L_ind_feat = 0.3 * self.MSEloss(feat, feat_2)
+            L_hdl_feat = 0.3 * self.MSEloss(feat, feat_3)
+
+            cl_loss = F.cross_entropy(output, all_y)
+            C_scale = cl_loss.detach().clamp(max=1.)
+            loss = cl_loss + C_scale * (lam * (L_ind_logit + L_ind_feat) + (1 - lam) * (L_hdl_logit + L_hdl_feat))
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 class SANDMask(ERM):
     """
@@ -2568,6 +2892,8 @@ class SANDMask(ERM):
     <https://arxiv.org/abs/2106.02266>
     """
 
+    SUPPORTS_AMP = False  # per-environment gradients combined by hand
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(SANDMask, self).__init__(input_shape, num_classes, num_domains, hparams)
 
@@ -2591,7 +2917,7 @@ class SANDMask(ERM):
             logits = self.network(x)
 
             env_loss = F.cross_entropy(logits, y)
-            mean_loss += env_loss.item() / len(minibatches)
+            mean_loss += env_loss.detach() / len(minibatches)
             env_grads = autograd.grad(env_loss, self.network.parameters(), retain_graph=True)
             for grads, env_grad in zip(param_gradients, env_grads):
                 grads.append(env_grad)
@@ -2628,6 +2954,8 @@ class SANDMask(ERM):
 class Fishr(Algorithm):
     "Invariant Gradients variances for Out-of-distribution Generalization"
 
+    SUPPORTS_AMP = False  # per-sample gradients (BackPACK)
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         assert backpack is not None, "Install backpack with: 'pip install backpack-for-pytorch==1.3.0'"
         super(Fishr, self).__init__(input_shape, num_classes, num_domains, hparams)
@@ -2684,7 +3012,7 @@ class Fishr(Algorithm):
         objective.backward()
         self.optimizer.step()
 
-        return {'loss': objective.item(), 'nll': all_nll.item(), 'penalty': penalty.item()}
+        return {'loss': objective.detach(), 'nll': all_nll.detach(), 'penalty': penalty.detach()}
 
     def compute_fishr_penalty(self, all_logits, all_y, len_minibatches):
         dict_grads = self._get_grads(all_logits, all_y)
@@ -2761,6 +3089,8 @@ class TRM(Algorithm):
     <https://arxiv.org/abs/2110.09940>
     """
 
+    SUPPORTS_AMP = False  # several optimizers and hand-made gradients
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(TRM, self).__init__(input_shape, num_classes, num_domains, hparams)
         self.register_buffer('update_count', torch.tensor([0]))
@@ -2898,7 +3228,7 @@ class TRM(Algorithm):
             all_feature = self.featurizer(all_x)
             loss = F.cross_entropy(self.classifier(all_feature), all_y)
 
-        nll = loss.item()
+        nll = loss.detach()
         self.optimizer_c.zero_grad()
         self.optimizer_f.zero_grad()
         if self.update_count >= self.hparams['iters']:
@@ -2910,7 +3240,7 @@ class TRM(Algorithm):
         self.optimizer_f.step()
         self.optimizer_c.step()
 
-        loss_swap = loss_swap.item() - nll
+        loss_swap = loss_swap.detach() - nll
         self.update_count += 1
 
         return {'nll': nll, 'trm_loss': loss_swap}
@@ -2947,22 +3277,23 @@ class IB_ERM(ERM):
         ib_penalty = 0.
 
         all_x = torch.cat([x for x, y in minibatches])
-        all_features = self.featurizer(all_x)
-        all_logits = self.classifier(all_features)
-        all_logits_idx = 0
-        for i, (x, y) in enumerate(minibatches):
-            features = all_features[all_logits_idx:all_logits_idx + x.shape[0]]
-            logits = all_logits[all_logits_idx:all_logits_idx + x.shape[0]]
-            all_logits_idx += x.shape[0]
-            nll += F.cross_entropy(logits, y)
-            ib_penalty += features.var(dim=0).mean()
+        with self.forward_pass():
+            all_features = self.featurizer(all_x)
+            all_logits = self.classifier(all_features)
+            all_logits_idx = 0
+            for i, (x, y) in enumerate(minibatches):
+                features = all_features[all_logits_idx:all_logits_idx + x.shape[0]]
+                logits = all_logits[all_logits_idx:all_logits_idx + x.shape[0]]
+                all_logits_idx += x.shape[0]
+                nll += F.cross_entropy(logits, y)
+                ib_penalty += features.var(dim=0).mean()
 
-        nll /= len(minibatches)
-        ib_penalty /= len(minibatches)
+            nll /= len(minibatches)
+            ib_penalty /= len(minibatches)
 
-        # Compile loss
-        loss = nll
-        loss += ib_penalty_weight * ib_penalty
+            # Compile loss
+            loss = nll
+            loss += ib_penalty_weight * ib_penalty
 
         if self.update_count == self.hparams['ib_penalty_anneal_iters']:
             # Reset Adam, because it doesn't like the sharp jump in gradient
@@ -2973,17 +3304,19 @@ class IB_ERM(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(),
-                'nll': nll.item(),
-                'IB_penalty': ib_penalty.item()}
+        return {'loss': loss.detach(),
+                'nll': nll.detach(),
+                'IB_penalty': ib_penalty.detach()}
 
 class IB_IRM(ERM):
     """Information Bottleneck based IRM on feature with conditionning"""
 
+    SUPPORTS_AMP = False  # gradient penalty (create_graph)
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(IB_IRM, self).__init__(input_shape, num_classes, num_domains,
                                      hparams)
@@ -3049,14 +3382,14 @@ class IB_IRM(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(),
-                'nll': nll.item(),
-                'IRM_penalty': irm_penalty.item(),
-                'IB_penalty': ib_penalty.item()}
+        return {'loss': loss.detach(),
+                'nll': nll.detach(),
+                'IRM_penalty': irm_penalty.detach(),
+                'IB_penalty': ib_penalty.detach()}
 
 class AbstractCAD(Algorithm):
     """Contrastive adversarial domain bottleneck (abstract class)
@@ -3186,22 +3519,23 @@ class AbstractCAD(Algorithm):
         device = "cuda" if minibatches[0][0].is_cuda else "cpu"
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-        all_z = self.featurizer(all_x)
-        all_d = torch.cat([
-            torch.full((x.shape[0],), i, dtype=torch.int64, device=device)
-            for i, (x, y) in enumerate(minibatches)
-        ])
-
-        bn_loss = self.bn_loss(all_z, all_y, all_d)
-        clf_out = self.classifier(all_z)
-        clf_loss = F.cross_entropy(clf_out, all_y)
-        total_loss = clf_loss + self.hparams['lmbda'] * bn_loss
+        with self.forward_pass():
+            all_z = self.featurizer(all_x)
+            all_d = torch.cat([
+                torch.full((x.shape[0],), i, dtype=torch.int64, device=device)
+                for i, (x, y) in enumerate(minibatches)
+            ])
+
+            bn_loss = self.bn_loss(all_z, all_y, all_d)
+            clf_out = self.classifier(all_z)
+            clf_loss = F.cross_entropy(clf_out, all_y)
+            total_loss = clf_loss + self.hparams['lmbda'] * bn_loss
 
         self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
+        self.backward(total_loss)
+        self.optimizer_step(self.optimizer)
 
-        return {"clf_loss": clf_loss.item(), "bn_loss": bn_loss.item(), "total_loss": total_loss.item()}
+        return {"clf_loss": clf_loss.detach(), "bn_loss": bn_loss.detach(), "total_loss": total_loss.detach()}
 
     def predict(self, x):
         return self.classifier(self.featurizer(x))
@@ -3251,15 +3585,16 @@ class Testing(Algorithm):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
 
-        output = self.predict(all_x)
+        with self.forward_pass():
+            output = self.predict(all_x)
 
-        loss = F.cross_entropy(output, all_y)
+            loss = F.cross_entropy(output, all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -3299,13 +3634,14 @@ class Distribution_shift(Algorithm):
     def update(self, minibatches, unlabeled=None):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-        loss = F.cross_entropy(self.predict(all_x), all_y)
+        with self.forward_pass():
+            loss = F.cross_entropy(self.predict(all_x), all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.optimizer_step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -3343,12 +3679,8 @@ class Distribution_shift(Algorithm):
         return normalize(mixed).to(device)
 
     def augment_input(self, x):
-        transform = T.ToPILImage()
-        trans1 = T.ToTensor()
-        aug_list = utils.augmentations
-        op = np.random.choice(aug_list)
-        out_list = torch.cat([torch.unsqueeze(trans1(op(transform(im), 1)), 0) for im in x])
-        return out_list
+        op = np.random.choice(augmix_batch.augmentations)
+        return op(x, 1)
 
     def predict(self, x):
         # if torch.cuda.is_available():
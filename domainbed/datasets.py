@@ -1,6 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
 import os
+import warnings
 import torch
 import math
 from PIL import Image, ImageFile
@@ -18,6 +19,10 @@ from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.data import create_transform
 from torchvision.transforms.functional import InterpolationMode
 from domainbed.lib.cifar10c import CIFAR10C as cifar10c
+from domainbed.lib.image_cache import CachedImageFolder
+from domainbed.lib.manifest import ManifestImageFolder
+from domainbed.lib.batch_augment import BatchAugment, raw_transform
+from domainbed.lib import env_cache
 
 # MNISTM, SYN,
 # from wilds.datasets.camelyon17_dataset import Camelyon17Dataset
@@ -57,6 +62,15 @@ DATASETS = [
 
 
 
+def image_batch_augment(hparams, augment, mean, std):
+    """Batched equivalent of the ImageFolder/PACS train transforms below."""
+    if augment:
+        return BatchAugment(224, crop=("resized", (0.7, 1.0), (3. / 4., 4. / 3.)),
+            hflip=0.5, color_jitter=(0.3, 0.3, 0.3, 0.3), grayscale=0.1,
+            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    return BatchAugment(224, crop=("resized", (0.08, 1.0), (3. / 4., 4. / 3.)),
+        hflip=0.5, mean=mean if hparams["normalization"] else None, std=std)
+
 def get_dataset_class(dataset_name):
     """Return the dataset class with the given name."""
     if dataset_name not in globals():
@@ -96,6 +110,7 @@ class MultipleDomainDataset:
     ENVIRONMENTS = None      # Subclasses should override
     INPUT_SHAPE = None       # Subclasses should override
     STEPS_PER_EPOCH = None
+    batch_augment = None     # BatchAugment applied to uint8 train batches
     
 
     def __getitem__(self, index):
@@ -128,13 +143,41 @@ class Debug224(Debug):
     ENVIRONMENTS = ['0', '1', '2']
 
 
+def _env_cache_dir(root, hparams):
+    """Directory of the MNIST environment cache (hparams['env_cache']),
+    <root>/MNIST_env_cache unless hparams['env_cache_dir'] is set, or None
+    if the cache is off."""
+    if not hparams.get('env_cache', False):
+        return None
+    if hparams.get('env_cache_dir', " ") != " ":
+        return hparams['env_cache_dir']
+    return os.path.join(root, "MNIST_env_cache")
+
+
 class MultipleEnvironmentMNIST(MultipleDomainDataset):
     def __init__(self, root, environments, dataset_transform, input_shape,
-                 num_classes):
+                 num_classes, cache_dir=None):
         super().__init__()
         if root is None:
             raise ValueError('Data directory not specified!')
 
+        # Environments are fully determined by the class, its environment
+        # parameters and the torch RNG state used for shuffling/coloring.
+        cache_path = cached = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, "{}_{}.bin".format(
+                type(self).__name__, env_cache.cache_key(type(self).__name__,
+                    environments, torch.get_rng_state())))
+            cached = env_cache.load(cache_path)
+        if cached is not None:
+            self.datasets = [TensorDataset(cached["x{}".format(i)], cached["y{}".format(i)])
+                             for i in range(len(environments))]
+            # leave the RNG where building the environments would have left it
+            torch.set_rng_state(cached["rng_state"].clone())
+            self.input_shape = input_shape
+            self.num_classes = num_classes
+            return
+
         original_dataset_tr = MNIST(root, train=True, download=True)
         original_dataset_te = MNIST(root, train=False, download=True)
 
@@ -157,6 +200,16 @@ class MultipleEnvironmentMNIST(MultipleDomainDataset):
             labels = original_labels[i::len(environments)]
             self.datasets.append(dataset_transform(images, labels, environments[i]))
 
+        if cache_path is not None:
+            arrays = {"rng_state": torch.get_rng_state()}
+            for i, env in enumerate(self.datasets):
+                arrays["x{}".format(i)], arrays["y{}".format(i)] = env.tensors
+            try:
+                env_cache.save(cache_path, arrays)
+            except OSError as e:
+                warnings.warn("Could not write environment cache {}: {}".format(
+                    cache_path, e))
+
         self.input_shape = input_shape
         self.num_classes = num_classes
 
@@ -166,7 +219,8 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
    
     def __init__(self, root, test_envs, hparams):
         super(ColoredMNIST, self).__init__(root, [0.1, 0.2, 0.9],
-                                         self.color_dataset, (2, 28, 28,), 2)
+                                         self.color_dataset, (2, 28, 28,), 2,
+                                         cache_dir=_env_cache_dir(root, hparams))
 
         self.input_shape = (2, 28, 28,)
         self.num_classes = 2
@@ -206,18 +260,14 @@ class RotatedMNIST(MultipleEnvironmentMNIST):
 
     def __init__(self, root, test_envs, hparams):
         super(RotatedMNIST, self).__init__(root, [0, 15, 30, 45, 60, 75],
-                                           self.rotate_dataset, (1, 28, 28,), 10)
+                                           self.rotate_dataset, (1, 28, 28,), 10,
+                                           cache_dir=_env_cache_dir(root, hparams))
 
     def rotate_dataset(self, images, labels, angle):
-        rotation = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Lambda(lambda x: rotate(x, angle, fill=(0,),
-                interpolation=torchvision.transforms.InterpolationMode.BILINEAR)),
-            transforms.ToTensor()])
-
-        x = torch.zeros(len(images), 1, 28, 28)
-        for i in range(len(images)):
-            x[i] = rotation(images[i])
+        # one batched affine-grid resample for the whole environment
+        x = images.unsqueeze(1).float().div_(255.0)
+        x = rotate(x, angle, fill=[0.],
+            interpolation=torchvision.transforms.InterpolationMode.BILINEAR)
 
         y = labels.view(-1)
 
@@ -251,13 +301,9 @@ class CIFAR10C(MultipleDomainDataset):
         #     ])
         # else:
 
-        test_transform = transforms.Compose(
-                [transforms.ToTensor(),
-                 transforms.Normalize([0.5] * 3, [0.5] * 3)
-                ])
-
         for corruption in envs:
-            datast = cifar10c(root, corruption, transform=test_transform)
+            # normalized straight from the memory-mapped uint8 arrays
+            datast = cifar10c(root, corruption, mean=[0.5] * 3, std=[0.5] * 3)
             self.datasets.append(datast)
 
         self.input_shape = self.INPUT_SHAPE
@@ -285,6 +331,11 @@ class CIFAR10(MultipleDomainDataset):
 
         hparams["mean_std"]=[[0.5] * 3, [0.5] * 3]        
 
+        if hparams['batch_augment']:
+            self.batch_augment = BatchAugment(32, crop=("pad", 4), hflip=0.5,
+                mean=[0.5] * 3 if hparams["normalization"] else None, std=[0.5] * 3)
+            train_transform = raw_transform()
+
         test_transform = transforms.Compose(
                 [transforms.ToTensor(),
                 transforms.Normalize([0.5] * 3, [0.5] * 3)])
@@ -329,6 +380,11 @@ class DIGITS(MultipleDomainDataset):
 
         hparams["mean_std"] = [[0.5, 0.5, 0.5],[0.5, 0.5, 0.5]]
 
+        if hparams['batch_augment']:
+            self.batch_augment = BatchAugment(32, crop=("resized", (0.5, 1.0), (3. / 4., 4. / 3.)),
+                mean=[0.5] * 3 if hparams["normalization"] else None, std=[0.5] * 3)
+            train_transform = raw_transform()
+
         #loading MNIST DATASET
         original_dataset_tr = MNIST(root, train=True, transform=train_transform, download=True)
         original_dataset_te = MNIST(root, train=False, transform=transform, download=True)
@@ -406,6 +462,11 @@ class PACS_Custom(MultipleDomainDataset):
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
+        if hparams['batch_augment']:
+            self.batch_augment = image_batch_augment(hparams,
+                hparams['data_augmentation'], MEAN, STD)
+            transform = augment_transform = raw_transform(hparams['batch_augment_size'])
+
         self.datasets = []
         for i, environment in enumerate(environments):
 
@@ -493,6 +554,10 @@ class MultipleEnvironmentImageFolder(MultipleDomainDataset):
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
+        if hparams['batch_augment']:
+            self.batch_augment = image_batch_augment(hparams, augment, MEAN, STD)
+            transform = augment_transform = raw_transform(hparams['batch_augment_size'])
+
         self.datasets = []
         for i, environment in enumerate(environments):
 
@@ -531,8 +596,20 @@ class MultipleEnvironmentImageFolder(MultipleDomainDataset):
                 
                 
             path = os.path.join(root, environment)
-            env_dataset = ImageFolder(path,
-                transform=env_transform)
+            manifest_dir = None if hparams['manifest_dir'] == " " else hparams['manifest_dir']
+            if hparams['image_cache']:
+                env_dataset = CachedImageFolder(path,
+                    cache_dir=None if hparams['image_cache_dir'] == " " else hparams['image_cache_dir'],
+                    short_side=hparams['image_cache_size'],
+                    transform=env_transform,
+                    manifest_dir=manifest_dir)
+            elif hparams['env_manifest']:
+                env_dataset = ManifestImageFolder(path,
+                    manifest_dir=manifest_dir,
+                    transform=env_transform)
+            else:
+                env_dataset = ImageFolder(path,
+                    transform=env_transform)
             self.datasets.append(env_dataset)
             ################################ Code required for RCERM ################################ 
             # env_dataset: <class 'torchvision.datasets.folder.ImageFolder'>, 
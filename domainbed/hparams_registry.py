@@ -49,6 +49,19 @@ def _hparams(algorithm, dataset, random_seed):
     _hparam('continue_checkpoint'," ",lambda r:" ")
     _hparam('total_steps', 0, lambda r: r.choice([0]))
     _hparam('checkpoint_step_start', 0, lambda r: r.choice([0]))
+    _hparam('image_cache', False, lambda r: False)
+    _hparam('image_cache_dir', " ", lambda r: " ")
+    _hparam('image_cache_size', 256, lambda r: 256)
+    _hparam('env_manifest', False, lambda r: False)
+    _hparam('manifest_dir', " ", lambda r: " ")
+    _hparam('env_cache', False, lambda r: False)
+    _hparam('env_cache_dir', " ", lambda r: " ")
+    _hparam('batch_augment', False, lambda r: False)
+    _hparam('batch_augment_size', 256, lambda r: 256)
+    _hparam('amp', " ", lambda r: " ")
+    _hparam('compile', False, lambda r: False)
+    _hparam('compile_cache_dir', " ", lambda r: " ")
+    _hparam('fused_views_max_batch', 0, lambda r: 0)
     # TODO: nonlinear classifiers disabled
     _hparam('nonlinear_classifier', False,
             lambda r: bool(r.choice([False, False])))
@@ -142,6 +155,9 @@ def _hparams(algorithm, dataset, random_seed):
          _hparam('lr_adv', 5e-5, lambda r: r.choice([5e-6, 5e-5]))
          _hparam('adv_steps', 10, lambda r: r.choice([5, 8]))
          _hparam('elbo_beta', 1.0, lambda r: r.choice([0.2, 0.3]))
+         _hparam('adv_refresh_every', 1, lambda r: 1)
+         _hparam('adv_warm_start', False, lambda r: False)
+         _hparam('adv_frozen_backbone', False, lambda r: False)
          _hparam('clw', 0.75, lambda r: r.choice([0.2, 0.3]))
          _hparam('pre_epoch', 5.0, lambda r: r.choice([3.0, 5.0]))
          _hparam('mean_std', [[0.5] * 3, [0.5] * 3], lambda r: [[0.1] * 3, [0.5] * 3])
@@ -157,6 +173,9 @@ def _hparams(algorithm, dataset, random_seed):
          _hparam('clw', 0.75, lambda r: r.choice([0.2, 0.3]))
          _hparam('pre_epoch', 5.0, lambda r: r.choice([3.0, 5.0]))
          _hparam('mean_std', [[0.5] * 3, [0.5] * 3], lambda r: [[0.1] * 3, [0.5] * 3])
+         _hparam('adv_refresh_every', 1, lambda r: 1)
+         _hparam('adv_warm_start', False, lambda r: False)
+         _hparam('adv_frozen_backbone', False, lambda r: False)
 
 
     elif algorithm == 'RandConv_CNN' or algorithm == 'RandConv_ViT' :
@@ -165,6 +184,8 @@ def _hparams(algorithm, dataset, random_seed):
         _hparam('alpha_max', 1.0, lambda r: r.choice([0.0, 0.5]))
         _hparam('kernel_size', 0.0, lambda r: r.choice([0.0, 3.0]))
         _hparam('randomize_kernel', True, lambda r: True)
+        _hparam('randconv_batched', False, lambda r: False)
+        _hparam('randconv_group_size', 1, lambda r: 1)
         _hparam('loss_aug', True, lambda r: True)
         _hparam('mixing', True, lambda r:  bool(r.choice([True, False])))
         _hparam('invariant_loss', True, lambda r: True)
@@ -179,6 +200,8 @@ def _hparams(algorithm, dataset, random_seed):
          _hparam('mixture_depth', -1, lambda r: r.choice([1, -1]))
          _hparam('aug_severity', 3.0, lambda r: r.choice([1.0, 5.0]))
          _hparam('mean_std', [[0.5] * 3, [0.5] * 3], lambda r: [[0.1] * 3, [0.5] * 3])
+         _hparam('augmix_in_loader', False, lambda r: False)
+         _hparam('augmix_batched', False, lambda r: False)
 
     elif algorithm == 'New_CNN' :
          _hparam('lr_adv', 0.2, lambda r: r.choice([0.3, 0.2]))
@@ -15,7 +15,9 @@
 """Base augmentations operators."""
 
 import numpy as np
+import torch
 from PIL import Image, ImageOps, ImageEnhance
+from torchvision import transforms
 
 # ImageNet code should change this value
 IMAGE_SIZE = 32
@@ -147,3 +149,72 @@ augmentations_all = [
     autocontrast, equalize, posterize, rotate, solarize, shear_x, shear_y,
     translate_x, translate_y, color, contrast, brightness, sharpness
 ]
+
+
+def augment_and_mix(image, preprocess, hparams):
+  """Perform AugMix augmentations and compute mixture.
+
+  Args:
+    image: PIL.Image input image
+    preprocess: Preprocessing function which should return a torch tensor.
+    hparams: AugMix hparams (mixture_width, mixture_depth, aug_severity,
+      all_ops).
+
+  Returns:
+    mixed: Augmented and mixed image.
+  """
+  aug_list = augmentations_all if hparams["all_ops"] else augmentations
+
+  ws = np.float32(np.random.dirichlet([1] * hparams["mixture_width"]))
+  m = np.float32(np.random.beta(1, 1))
+
+  mix = torch.zeros_like(preprocess(image))
+  for i in range(hparams["mixture_width"]):
+    image_aug = image.copy()
+    depth = hparams["mixture_depth"] if hparams["mixture_depth"] > 0 else np.random.randint(
+        1, 4)
+    for _ in range(depth):
+      op = np.random.choice(aug_list)
+      image_aug = op(image_aug, hparams["aug_severity"])
+    # Preprocessing commutes since all coefficients are convex
+    mix += ws[i] * preprocess(image_aug)
+
+  mixed = (1 - m) * preprocess(image) + m * mix
+  return mixed
+
+
+def _set_image_size(image_size):
+  global IMAGE_SIZE
+  IMAGE_SIZE = image_size
+
+
+class AugMixDataset(torch.utils.data.Dataset):
+  """Wraps a dataset of unnormalized image tensors so that every sample is
+  the stacked (clean, aug1, aug2) triple of preprocessed images, a
+  (3, C, H, W) tensor. The AugMix chains then run in the DataLoader
+  workers instead of the training step. The clean view is normalized
+  directly from the float tensor, as in the training step."""
+
+  def __init__(self, dataset, hparams, image_size):
+    self.dataset = dataset
+    self.hparams = hparams
+    self.image_size = image_size
+    self.normalize = transforms.Normalize(hparams["mean_std"][0],
+                                          hparams["mean_std"][1])
+    self.preprocess = transforms.Compose([transforms.ToTensor(), self.normalize])
+    _set_image_size(image_size)
+
+  def __setstate__(self, state):
+    # spawned loader workers unpickle the dataset into a fresh module
+    self.__dict__.update(state)
+    _set_image_size(self.image_size)
+
+  def __getitem__(self, i):
+    x, y = self.dataset[i]
+    image = transforms.ToPILImage()(x)
+    return torch.stack([self.normalize(x),
+                        augment_and_mix(image, self.preprocess, self.hparams),
+                        augment_and_mix(image, self.preprocess, self.hparams)]), y
+
+  def __len__(self):
+    return len(self.dataset)
@@ -0,0 +1,206 @@
+"""
+Batched tensor versions of the AugMix operations in augmix_augmentations.py.
+
+Every op takes a float (B, C, H, W) batch in [0, 1] and the severity, and
+samples its level (and sign) independently for every sample, like the PIL
+op does per image. `augment_and_mix` runs the whole AugMix chain on a
+batch, with per-sample mixing weights, chain depths and ops.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from domainbed.lib.batch_augment import (
+    _blend, adjust_brightness, adjust_contrast, adjust_saturation)
+
+
+def _sample_level(x, n):
+    return torch.empty(x.size(0), device=x.device).uniform_(0.1, n)
+
+
+def _int_parameter(level, maxval):
+    return torch.floor(level * maxval / 10)
+
+
+def _float_parameter(level, maxval):
+    return level * maxval / 10.
+
+
+def _random_sign(level):
+    return torch.where(torch.rand_like(level) > 0.5, -level, level)
+
+
+def _per_sample(v):
+    return v.view(-1, 1, 1, 1)
+
+
+def _to_uint8(x):
+    # pixel values 0..255, kept as floats
+    return (x * 255).round()
+
+
+def _affine(x, a, b, c, d, e, f):
+    """Resample `x` at input = [[a, b, c], [d, e, f]] @ output, in normalized
+    coordinates, with bilinear interpolation and black fill (as PIL)."""
+    theta = torch.stack([a, b, c, d, e, f], dim=1).view(-1, 2, 3)
+    grid = F.affine_grid(theta, x.shape, align_corners=False)
+    return F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros",
+                         align_corners=False)
+
+
+def autocontrast(x, _):
+    lo = x.amin(dim=(-2, -1), keepdim=True)
+    hi = x.amax(dim=(-2, -1), keepdim=True)
+    flat = hi <= lo
+    scale = 1. / torch.where(flat, torch.ones_like(hi), hi - lo)
+    lo = torch.where(flat, torch.zeros_like(lo), lo)
+    return ((x - lo) * scale).clamp(0, 1)
+
+
+def equalize(x, _):
+    # same lookup table as PIL.ImageOps.equalize, per sample and channel
+    n, c, h, w = x.shape
+    q = _to_uint8(x).long().view(n * c, h * w)
+    hist = torch.zeros(n * c, 256, device=x.device).scatter_add_(
+        1, q, torch.ones(q.shape, device=x.device))
+    last = ((hist > 0) * torch.arange(256, device=x.device)).amax(dim=1, keepdim=True)
+    step = torch.floor((hist.sum(dim=1, keepdim=True) - hist.gather(1, last)) / 255)
+    lut = torch.floor((hist.cumsum(dim=1) + torch.floor(step / 2)) / step.clamp(min=1))
+    lut = F.pad(lut, (1, 0))[:, :-1].clamp(0, 255)
+    out = torch.where(step > 0, lut.gather(1, q), q.float())
+    return (out / 255).view(n, c, h, w)
+
+
+def posterize(x, level):
+    bits = 4 - _int_parameter(_sample_level(x, level), 4)
+    shift = _per_sample(2 ** (8 - bits))
+    return torch.floor(_to_uint8(x) / shift) * shift / 255
+
+
+def rotate(x, level):
+    degrees = _random_sign(_int_parameter(_sample_level(x, level), 30))
+    rad = degrees * math.pi / 180
+    cos, sin = torch.cos(rad), torch.sin(rad)
+    zero = torch.zeros_like(cos)
+    # counter-clockwise, like PIL.Image.rotate
+    return _affine(x, cos, -sin, zero, sin, cos, zero)
+
+
+def solarize(x, level):
+    threshold = 256 - _int_parameter(_sample_level(x, level), 256)
+    return torch.where(_to_uint8(x) >= _per_sample(threshold), 1 - x, x)
+
+
+def shear_x(x, level):
+    # PIL affine data (1, level, 0, 0, 1, 0) in pixels, origin top-left
+    level = _random_sign(_float_parameter(_sample_level(x, level), 0.3))
+    h, w = x.shape[-2:]
+    one, zero = torch.ones_like(level), torch.zeros_like(level)
+    return _affine(x, one, level * h / w, level * (h - 1) / w,
+                   zero, one, zero)
+
+
+def shear_y(x, level):
+    level = _random_sign(_float_parameter(_sample_level(x, level), 0.3))
+    h, w = x.shape[-2:]
+    one, zero = torch.ones_like(level), torch.zeros_like(level)
+    return _affine(x, one, zero, zero,
+                   level * w / h, one, level * (w - 1) / h)
+
+
+def translate_x(x, level):
+    w = x.size(-1)
+    level = _random_sign(_int_parameter(_sample_level(x, level), w / 3))
+    one, zero = torch.ones_like(level), torch.zeros_like(level)
+    return _affine(x, one, zero, 2 * level / w, zero, one, zero)
+
+
+def translate_y(x, level):
+    h = x.size(-2)
+    level = _random_sign(_int_parameter(_sample_level(x, level), h / 3))
+    one, zero = torch.ones_like(level), torch.zeros_like(level)
+    return _affine(x, one, zero, zero, zero, one, 2 * level / h)
+
+
+def _enhance_factor(x, level):
+    return _float_parameter(_sample_level(x, level), 1.8) + 0.1
+
+
+# operation that overlaps with ImageNet-C's test set
+def color(x, level):
+    return adjust_saturation(x, _enhance_factor(x, level))
+
+
+# operation that overlaps with ImageNet-C's test set
+def contrast(x, level):
+    return adjust_contrast(x, _enhance_factor(x, level))
+
+
+# operation that overlaps with ImageNet-C's test set
+def brightness(x, level):
+    return adjust_brightness(x, _enhance_factor(x, level))
+
+
+# operation that overlaps with ImageNet-C's test set
+def sharpness(x, level):
+    # PIL's SMOOTH filter, border pixels are left unchanged
+    kernel = x.new_tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]]) / 13
+    blurred = F.conv2d(x, kernel.expand(x.size(1), 1, 3, 3), groups=x.size(1))
+    degenerate = x.clone()
+    degenerate[..., 1:-1, 1:-1] = blurred
+    return _blend(x, degenerate, _per_sample(_enhance_factor(x, level)))
+
+
+augmentations = [
+    autocontrast, equalize, posterize, rotate, solarize, shear_x, shear_y,
+    translate_x, translate_y
+]
+
+augmentations_all = [
+    autocontrast, equalize, posterize, rotate, solarize, shear_x, shear_y,
+    translate_x, translate_y, color, contrast, brightness, sharpness
+]
+
+
+def apply_ops(x, op_ids, ops, severity):
+    """Apply ops[op_ids[i]] to sample i of `x`; samples with op id -1 are
+    left unchanged. Every op runs once, on the samples that drew it."""
+    out = x.clone()
+    for k, op in enumerate(ops):
+        idx = (op_ids == k).nonzero(as_tuple=True)[0]
+        if len(idx) > 0:
+            out[idx] = op(x[idx], severity).to(out.dtype)
+    return out
+
+
+@torch.no_grad()
+def augment_and_mix(x, hparams):
+    """AugMix of a float (B, C, H, W) batch in [0, 1], with independent
+    Dirichlet/Beta mixing weights, chain depths and ops for every sample.
+    The result is not normalized; normalization commutes with the convex
+    mixing, so it can be applied afterwards."""
+    ops = augmentations_all if hparams["all_ops"] else augmentations
+    n, width = x.size(0), hparams["mixture_width"]
+    ws = torch.distributions.Dirichlet(x.new_ones(width)).sample((n,))
+    m = torch.rand(n, device=x.device)  # Beta(1, 1)
+
+    if hparams["mixture_depth"] > 0:
+        max_depth = hparams["mixture_depth"]
+    else:
+        max_depth = 3
+    mix = torch.zeros_like(x)
+    for i in range(width):
+        if hparams["mixture_depth"] > 0:
+            depth = torch.full((n,), max_depth, device=x.device)
+        else:
+            depth = torch.randint(1, 4, (n,), device=x.device)
+        x_aug = x
+        for d in range(max_depth):
+            op_ids = torch.randint(len(ops), (n,), device=x.device)
+            op_ids = op_ids.masked_fill(depth <= d, -1)
+            x_aug = apply_ops(x_aug, op_ids, ops, hparams["aug_severity"])
+        mix += _per_sample(ws[:, i]) * x_aug
+
+    return _per_sample(1 - m) * x + _per_sample(m) * mix
@@ -0,0 +1,219 @@
+"""
+Batched tensor versions of the torchvision train transforms used in
+datasets.py (RandomResizedCrop, RandomCrop, RandomHorizontalFlip,
+ColorJitter, RandomGrayscale, Normalize).
+
+Loader workers only resize and convert images to uint8 tensors
+(`raw_transform`); `BatchAugment` then applies the random augmentations to
+the whole (B, C, H, W) batch on the model device, with independent random
+parameters for every sample.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+
+def raw_transform(size=None):
+    """Worker-side transform: optional resize to a fixed (size, size) and
+    conversion to a uint8 CHW tensor."""
+    ops = []
+    if size is not None:
+        ops.append(transforms.Resize((size, size), antialias=True))
+    ops.append(transforms.PILToTensor())
+    return transforms.Compose(ops)
+
+
+def rgb_to_grayscale(x):
+    r, g, b = x.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _blend(x1, x2, ratio):
+    return (ratio * x1 + (1.0 - ratio) * x2).clamp(0, 1)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=1)
+    maxc = x.max(dim=1).values
+    minc = x.min(dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(x):
+    h, s, v = x.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32)
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    i = i % 6
+    mask = i.unsqueeze(dim=1) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=x.dtype), a4)
+
+
+def adjust_brightness(x, factor):
+    return (x * factor.view(-1, 1, 1, 1)).clamp(0, 1)
+
+
+def adjust_contrast(x, factor):
+    mean = rgb_to_grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+    return _blend(x, mean, factor.view(-1, 1, 1, 1))
+
+
+def adjust_saturation(x, factor):
+    return _blend(x, rgb_to_grayscale(x), factor.view(-1, 1, 1, 1))
+
+
+def adjust_hue(x, factor):
+    hsv = _rgb_to_hsv(x)
+    h = torch.remainder(hsv[:, 0] + factor.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+
+
+class BatchAugment(torch.nn.Module):
+    """Applies the train-time augmentations to a uint8 (B, C, H, W) batch and
+    returns a float batch of shape (B, 3, size, size).
+
+    crop: None, ("resized", scale, ratio) for RandomResizedCrop or
+        ("pad", padding) for RandomCrop with zero padding.
+    """
+
+    def __init__(self, size, crop=None, hflip=0.0, color_jitter=None,
+                 grayscale=0.0, mean=None, std=None):
+        super(BatchAugment, self).__init__()
+        self.size = size
+        self.crop = crop
+        self.hflip = hflip
+        self.color_jitter = color_jitter
+        self.grayscale = grayscale
+        if mean is not None:
+            self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+            self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
+        else:
+            self.mean = None
+
+    def _resized_crop_boxes(self, n, height, width, scale, ratio, device):
+        """Vectorized RandomResizedCrop.get_params: returns (i, j, h, w) per
+        sample, using the first of 10 valid attempts and the same centre-crop
+        fallback as torchvision."""
+        area = height * width
+        attempts = 10
+        target_area = area * torch.empty(n, attempts, device=device).uniform_(*scale)
+        log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        aspect = torch.exp(torch.empty(n, attempts, device=device).uniform_(*log_ratio))
+        w = torch.sqrt(target_area * aspect).round()
+        h = torch.sqrt(target_area / aspect).round()
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = torch.argmax(valid.int(), dim=1)
+        w = w.gather(1, first.unsqueeze(1)).squeeze(1)
+        h = h.gather(1, first.unsqueeze(1)).squeeze(1)
+        any_valid = valid.any(dim=1)
+
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(ratio):
+            fw, fh = width, int(round(width / min(ratio)))
+        elif in_ratio > max(ratio):
+            fw, fh = int(round(height * max(ratio))), height
+        else:
+            fw, fh = width, height
+        w = torch.where(any_valid, w, torch.full_like(w, fw))
+        h = torch.where(any_valid, h, torch.full_like(h, fh))
+
+        u = torch.rand(n, 2, device=device)
+        i = torch.floor(u[:, 0] * (height - h + 1))
+        j = torch.floor(u[:, 1] * (width - w + 1))
+        i = torch.where(any_valid, i, (height - h) / 2).round()
+        j = torch.where(any_valid, j, (width - w) / 2).round()
+        return i, j, h, w
+
+    def _geometry(self, x):
+        n, _, height, width = x.shape
+        device = x.device
+        if self.crop is None:
+            i = torch.zeros(n, device=device)
+            j = torch.zeros(n, device=device)
+            h = torch.full((n,), float(height), device=device)
+            w = torch.full((n,), float(width), device=device)
+        elif self.crop[0] == "resized":
+            i, j, h, w = self._resized_crop_boxes(n, height, width,
+                                                  self.crop[1], self.crop[2], device)
+        else:
+            pad = self.crop[1]
+            i = torch.randint(0, height + 2 * pad - self.size + 1, (n,), device=device).float() - pad
+            j = torch.randint(0, width + 2 * pad - self.size + 1, (n,), device=device).float() - pad
+            h = torch.full((n,), float(self.size), device=device)
+            w = torch.full((n,), float(self.size), device=device)
+
+        flip = torch.rand(n, device=device) < self.hflip
+        # crop box -> affine map of normalized output coords onto the input
+        sx = (w / width) * torch.where(flip, -1.0, 1.0)
+        sy = h / height
+        cx = (2 * j + w) / width - 1
+        cy = (2 * i + h) / height - 1
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = sx
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = sy
+        theta[:, 1, 2] = cy
+        grid = F.affine_grid(theta, (n, x.size(1), self.size, self.size),
+                             align_corners=False)
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros",
+                             align_corners=False)
+
+    def _color_jitter(self, x):
+        brightness, contrast, saturation, hue = self.color_jitter
+        n, device = x.size(0), x.device
+
+        def factor(v):
+            return torch.empty(n, device=device).uniform_(max(0., 1. - v), 1. + v)
+
+        ops = [(adjust_brightness, factor(brightness)),
+               (adjust_contrast, factor(contrast)),
+               (adjust_saturation, factor(saturation)),
+               (adjust_hue, torch.empty(n, device=device).uniform_(-hue, hue))]
+        # independent random op order per sample, like ColorJitter per call;
+        # every op runs once per position, on the samples that drew it there
+        order = torch.argsort(torch.rand(n, 4, device=device), dim=1)
+        x = x.clone()
+        for position in range(4):
+            for op_id, (op, f) in enumerate(ops):
+                idx = (order[:, position] == op_id).nonzero(as_tuple=True)[0]
+                if len(idx) > 0:
+                    x[idx] = op(x[idx], f[idx])
+        return x
+
+    @torch.no_grad()
+    def forward(self, x):
+        x = x.float().div_(255.0)
+        if x.size(1) == 1:
+            x = x.repeat(1, 3, 1, 1)
+        x = self._geometry(x)
+        if self.color_jitter is not None:
+            x = self._color_jitter(x)
+        if self.grayscale > 0:
+            gray = torch.rand(x.size(0), device=x.device) < self.grayscale
+            x = torch.where(gray.view(-1, 1, 1, 1),
+                            rgb_to_grayscale(x).expand_as(x), x)
+        if self.mean is not None:
+            x = (x - self.mean.to(x.device)) / self.std.to(x.device)
+        return x
@@ -0,0 +1,128 @@
+"""
+Background checkpoint writing.
+
+`snapshot` copies a state dict into reusable (pinned, on CUDA) host buffers
+without moving the live model off its device. `AsyncCheckpointWriter`
+serializes snapshots on a background thread and renames each file into
+place once it is complete. At most one write is in flight at a time.
+`get_rng_state`/`set_rng_state` capture every random generator so that a
+run can be resumed exactly.
+"""
+
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class AsyncCheckpointWriter:
+    def __init__(self):
+        self._thread = None
+        self._buffers = {}
+        self._error = None
+        self._any_cuda = False
+        self.last_write_time = 0.
+        self.last_write_step = None
+        self.last_snapshot_time = 0.
+
+    def wait(self):
+        """Block until the in-flight write (if any) has finished."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def snapshot(self, state):
+        """Copy every tensor of `state` (nested dicts, lists and tuples, e.g.
+        a state dict or an optimizer state) to host memory. Device-to-host
+        copies are issued asynchronously on the current stream; the returned
+        event marks their completion."""
+        self.wait()  # the previous write may still be reading the buffers
+        start = time.time()
+        self._any_cuda = False
+        snapshot = self._copy(state, ())
+        event = None
+        if self._any_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.last_snapshot_time = time.time() - start
+        return snapshot, event
+
+    def _copy(self, obj, key):
+        if isinstance(obj, dict):
+            return type(obj)((k, self._copy(v, key + (k,)))
+                             for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._copy(v, key + (i,))
+                             for i, v in enumerate(obj))
+        if not torch.is_tensor(obj):
+            return obj
+        tensor = obj.detach()
+        buffer = self._buffers.get(key)
+        if (buffer is None or buffer.shape != tensor.shape
+                or buffer.dtype != tensor.dtype):
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype,
+                                 pin_memory=tensor.is_cuda)
+            self._buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+        self._any_cuda = self._any_cuda or tensor.is_cuda
+        return buffer
+
+    def save(self, save_dict, paths, event=None, step=None):
+        """Write `save_dict` to every path in `paths` on a background
+        thread. Once the write has finished, its duration and `step` are
+        recorded as `last_write_time` and `last_write_step`."""
+        self.wait()
+
+        def _write():
+            try:
+                start = time.time()
+                if event is not None:
+                    event.synchronize()
+                for path in paths:
+                    tmp = path + ".tmp"
+                    torch.save(save_dict, tmp)
+                    os.replace(tmp, path)
+                self.last_write_time = time.time() - start
+                self.last_write_step = step
+            except Exception as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=_write, daemon=True)
+        self._thread.start()
+
+
+def get_rng_state():
+    """Python, NumPy, torch and (if available) CUDA generator states."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_model_dict(algorithm, model_dict):
+    """load_state_dict, ignoring the RandConv layers (their kernel size is
+    resampled at every step)."""
+    model_dict = {k: v for k, v in model_dict.items() if "rand_conv" not in k}
+    missing, unexpected = algorithm.load_state_dict(model_dict, strict=False)
+    missing = [k for k in missing if "rand_conv" not in k]
+    if missing or unexpected:
+        raise RuntimeError("Checkpoint does not match the model. Missing: {}, "
+                           "unexpected: {}".format(missing, unexpected))
@@ -14,8 +14,15 @@ from torchvision import datasets
 
 
 class CIFAR10C(datasets.VisionDataset):
+    """CIFAR-10-C corruption. The `.npy` arrays are memory-mapped, so only
+    the samples that are read are paged in.
+
+    If `mean`/`std` are given, samples are normalized directly from the
+    uint8 HWC arrays (no PIL round trip) and `transform` is ignored;
+    `__getitems__` then reads a whole batch with one indexing call.
+    """
     def __init__(self, root :str, name :str,
-                 transform=None, target_transform=None):
+                 transform=None, target_transform=None, mean=None, std=None):
         
         super(CIFAR10C, self).__init__(
             root, transform=transform,
@@ -28,19 +35,47 @@ class CIFAR10C(datasets.VisionDataset):
         data_path = os.path.join(root, name + '.npy')
         target_path = os.path.join(root, 'labels.npy')
         
-        self.data = np.load(data_path)
+        self.data = np.load(data_path, mmap_mode='r')
         self.targets = np.load(target_path)
-        
+
+        if mean is not None:
+            self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+            self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        else:
+            self.mean = self.std = None
+
+    def to_tensor(self, array):
+        """(N, H, W, C) uint8 array -> normalized (N, C, H, W) float tensor."""
+        x = torch.from_numpy(np.ascontiguousarray(array)).permute(0, 3, 1, 2)
+        return (x.float().div_(255.0) - self.mean) / self.std
+
     def __getitem__(self, index):
         img, targets = self.data[index], self.targets[index]
-        img = Image.fromarray(img)
+        if self.mean is not None:
+            img = self.to_tensor(img[None])[0]
+        else:
+            img = Image.fromarray(np.asarray(img))
         
-        if self.transform is not None:
-            img = self.transform(img)
+            if self.transform is not None:
+                img = self.transform(img)
         if self.target_transform is not None:
             targets = self.target_transform(targets)
             
         return img, targets
+
+    def __getitems__(self, indices):
+        if self.mean is None:
+            return [self[i] for i in indices]
+        indices = np.asarray(indices)
+        # sorted reads keep the memory-mapped access sequential
+        order = np.argsort(indices)
+        sorted_imgs = self.to_tensor(self.data[indices[order]])
+        imgs = torch.empty_like(sorted_imgs)
+        imgs[torch.from_numpy(order)] = sorted_imgs
+        targets = self.targets[indices]
+        if self.target_transform is not None:
+            targets = [self.target_transform(t) for t in targets]
+        return list(zip(imgs, targets))
     
     def __len__(self):
-        return len(self.data)
\ No newline at end of file
+        return len(self.data)
@@ -0,0 +1,80 @@
+"""
+Single-file, memory-mappable cache of preprocessed environment tensors.
+
+A cache file holds a JSON header followed by the raw bytes of every array.
+Arrays are opened with a copy-on-write memory map, so all jobs on a node
+share one copy of the data through the page cache.
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+CACHE_VERSION = 1
+_ALIGN = 64
+
+
+def cache_key(*parts):
+    """md5 of the string representation of `parts`. Tensors and arrays are
+    hashed by content."""
+    h = hashlib.md5("v{}".format(CACHE_VERSION).encode("utf-8"))
+    for part in parts:
+        if torch.is_tensor(part):
+            part = part.cpu().numpy()
+        if isinstance(part, np.ndarray):
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode("utf-8"))
+    return h.hexdigest()
+
+
+def save(path, arrays):
+    """Write the dict `arrays` (name -> tensor or ndarray) to `path`
+    atomically."""
+    header, blobs, offset = {}, [], 0
+    for name, array in arrays.items():
+        if torch.is_tensor(array):
+            array = array.cpu().numpy()
+        array = np.ascontiguousarray(array)
+        offset = (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+        header[name] = {"dtype": array.dtype.str, "shape": list(array.shape),
+                        "offset": offset}
+        blobs.append((offset, array))
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = (8 + len(header_bytes) + _ALIGN - 1) // _ALIGN * _ALIGN
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp{}".format(os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for offset, array in blobs:
+            f.seek(data_start + offset)
+            f.write(array.tobytes())
+    os.replace(tmp, path)
+
+
+def load(path):
+    """Return a dict name -> tensor backed by a memory map of `path`, or None
+    if there is no cache file."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = (8 + header_len + _ALIGN - 1) // _ALIGN * _ALIGN
+    arrays = {}
+    for name, meta in header.items():
+        shape = tuple(meta["shape"])
+        if int(np.prod(shape)) == 0:
+            array = np.zeros(shape, dtype=np.dtype(meta["dtype"]))
+        else:
+            array = np.memmap(path, dtype=np.dtype(meta["dtype"]), mode="c",
+                              offset=data_start + meta["offset"], shape=shape)
+        arrays[name] = torch.from_numpy(array)
+    return arrays
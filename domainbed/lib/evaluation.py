@@ -0,0 +1,326 @@
+"""
+Checkpoint evaluation, either in the training process or in a separate
+worker process that evaluates weight snapshots while training continues
+(`EvalWorker`). `CheckpointEvaluator` decides what a checkpoint evaluates.
+"""
+
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from domainbed import datasets
+from domainbed import networks
+from domainbed.lib import misc
+from domainbed.lib.checkpoint import AsyncCheckpointWriter, load_model_dict
+from domainbed.lib.fast_data_loader import FastDataLoader
+
+
+def evaluate(algorithm, evals, device, val_id, randconv=False,
+             batch_augment=None):
+    """
+    Accuracy and loss on every (name, loader, weights) of `evals`. Returns
+    the results dict and the validation accuracy, i.e. the mean accuracy of
+    the "out" splits of environment `val_id` (None if there are none).
+    """
+    results = {}
+    val_accs = []
+    for name, loader, weights in evals:
+        acc, loss = misc.accuracy(algorithm, loader, weights, device,
+                                  val_id=val_id, current_id=int(name[3]),
+                                  randconv=randconv,
+                                  batch_augment=batch_augment)
+        if _is_val(name, val_id):
+            val_accs.append(acc)
+        results[name + '_acc'] = acc
+        results[name + '_loss'] = loss
+    val_acc = sum(val_accs) / len(val_accs) if val_accs else None
+    return results, val_acc
+
+
+def _is_val(name, val_id):
+    return val_id == int(name[3]) and "out" in name
+
+
+def subsample(env, n, seed):
+    """Fixed random subset of `n` samples of `env` (all of `env` if it is not
+    larger than that)."""
+    if len(env) <= n:
+        return env
+    keys = np.random.RandomState(seed).permutation(len(env))[:n].tolist()
+    return _split(env, keys)
+
+
+def _split(env, keys):
+    if hasattr(env, 'subset'):
+        return env.subset(keys)
+    return misc._SplitDataset(env, keys)
+
+
+def split_keys(dataset, env):
+    """(environment index, keys) of `env`, an environment of `dataset` or a
+    split of one (keys is None for a whole environment), so that a worker
+    process can rebuild the split instead of receiving a pickled copy."""
+    for env_i, dataset_env in enumerate(dataset):
+        if env is dataset_env:
+            return env_i, None
+    if not hasattr(env, 'underlying_dataset'):
+        raise ValueError("Not a split of the dataset: {}".format(env))
+    env_i, keys = split_keys(dataset, env.underlying_dataset)
+    if keys is None:
+        return env_i, list(env.keys)
+    return env_i, [keys[k] for k in env.keys]
+
+
+def rebuild_split(dataset, env_i, keys):
+    """Inverse of `split_keys`."""
+    if keys is None:
+        return dataset[env_i]
+    return _split(dataset[env_i], keys)
+
+
+def confidence_interval(acc, n, total, z=1.96):
+    """Half-width of the normal-approximation confidence interval of an
+    accuracy measured on `n` of `total` samples drawn without
+    replacement."""
+    if n >= total:
+        return 0.
+    return z * math.sqrt(acc * (1 - acc) / n * (total - n) / (total - 1))
+
+
+class CheckpointEvaluator:
+    """
+    Evaluation policy for checkpoints. By default every environment is
+    evaluated in full.
+
+    With `subsample` > 0, intermediate checkpoints evaluate a fixed, seeded
+    subset of at most `subsample` samples per environment. Their accuracies
+    and losses are recorded as `<name>_acc_sub` and `<name>_loss_sub`, and
+    the 95% confidence half-width of every accuracy as `<name>_acc_ci`, so
+    model selection, which reads `<name>_acc`, only sees full evaluations.
+    The full evaluation is run at the final step, and whenever the upper
+    confidence bound of the validation accuracy reaches the best validation
+    accuracy so far, so best models are always selected on full
+    evaluations.
+
+    Environments named in `skip` are not evaluated at all.
+    """
+
+    def __init__(self, evals, device, n_workers, val_id, randconv=False,
+                 batch_augment=None, subsample_size=0, seed=0, skip=()):
+        evals = [(name, env, weights) for name, env, weights in evals
+                 if name not in skip]
+        self.device = device
+        self.val_id = val_id
+        self.subsample_size = subsample_size
+        self.eval_kwargs = dict(val_id=val_id, randconv=randconv,
+                                batch_augment=batch_augment)
+        self.full_evals = [(name, FastDataLoader(
+            dataset=env,
+            batch_size=128,
+            num_workers=n_workers), weights)
+            for name, env, weights in evals]
+        self.sub_evals = []
+        self.sizes = {}
+        if subsample_size > 0:
+            for name, env, _ in evals:
+                sub_env = subsample(env, subsample_size, misc.seed_hash(seed, name))
+                self.sizes[name] = (len(sub_env), len(env))
+                self.sub_evals.append((name, FastDataLoader(
+                    dataset=sub_env,
+                    batch_size=128,
+                    num_workers=n_workers), None))
+
+    def __call__(self, algorithm, final=False, best_val_acc=0):
+        """Returns the results dict, the validation accuracy and whether the
+        evaluation was a full one."""
+        if self.sub_evals and not final:
+            results, val_acc = evaluate(algorithm, self.sub_evals,
+                                        self.device, **self.eval_kwargs)
+            val_cis = []
+            for name, (n, total) in self.sizes.items():
+                ci = confidence_interval(results[name + '_acc'], n, total)
+                results[name + '_acc_ci'] = ci
+                if _is_val(name, self.val_id):
+                    val_cis.append(ci)
+            if val_acc is None or (val_acc + math.sqrt(sum(ci ** 2 for ci in val_cis))
+                                   / len(val_cis) < best_val_acc):
+                results = {key + '_sub' if key.endswith(('_acc', '_loss')) else key: v
+                           for key, v in results.items()}
+                results['eval_subsample'] = self.subsample_size
+                return results, val_acc, False
+
+        results, val_acc = evaluate(algorithm, self.full_evals, self.device,
+                                    **self.eval_kwargs)
+        results['eval_subsample'] = 0
+        return results, val_acc, True
+
+
+def is_better(val_acc, step, best_val_acc, best_step):
+    """Best-model rule that does not depend on the order in which steps are
+    evaluated: the highest accuracy wins, ties go to the later step."""
+    return val_acc is not None and (
+        val_acc > best_val_acc or (val_acc == best_val_acc and step > best_step))
+
+
+def write_results(results, output_dir, last_results_keys=None):
+    """Print a results row (with a header if the keys changed) and append it
+    to results.jsonl. Returns the printed keys."""
+    printed = {k: v for k, v in results.items() if k not in ('hparams', 'args')}
+    results_keys = sorted(printed.keys())
+    if results_keys != last_results_keys:
+        misc.print_row(results_keys, colwidth=12)
+    misc.print_row([printed[key] for key in results_keys], colwidth=12)
+
+    with open(os.path.join(output_dir, 'results.jsonl'), 'a') as f:
+        f.write(json.dumps(results, sort_keys=True) + "\n")
+    return results_keys
+
+
+def rebuild_dataset(dataset_args):
+    """Build the dataset of `dataset_args` (dataset name, data_dir,
+    test_envs, hparams and seed) exactly as train.py did: some datasets
+    (e.g. ColoredMNIST) shuffle their environments with the global RNGs,
+    which train.py seeds right before building the dataset."""
+    dataset_name, data_dir, test_envs, dataset_hparams, seed = dataset_args
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    return vars(datasets)[dataset_name](data_dir, test_envs, dataset_hparams)
+
+
+def _worker_main(algorithm_class, algorithm_args, dataset_args, eval_splits,
+                 device, evaluator_kwargs, output_dir, save_dict, best, jobs,
+                 done):
+    sys.stdout = misc.Tee(os.path.join(output_dir, 'out.txt'))
+    sys.stderr = misc.Tee(os.path.join(output_dir, 'err.txt'))
+
+    algorithm = algorithm_class(*algorithm_args)
+    algorithm.to(device)
+    networks.compile_algorithm(algorithm)
+
+    dataset = rebuild_dataset(dataset_args)
+    if dataset.batch_augment is not None:
+        dataset.batch_augment.to(device)
+    evals = [(name, rebuild_split(dataset, env_i, keys), weights)
+             for name, (env_i, keys), weights in eval_splits]
+    evaluator = CheckpointEvaluator(evals, device, dataset.N_WORKERS,
+                                    batch_augment=dataset.batch_augment,
+                                    **evaluator_kwargs)
+
+    best_val_acc, best_step = best
+    last_results_keys = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        step, model_dict, results, final = job
+        load_model_dict(algorithm, model_dict)
+        eval_results, val_acc, full = evaluator(algorithm, final, best_val_acc)
+        results.update(eval_results)
+
+        if full and is_better(val_acc, step, best_val_acc, best_step):
+            best_val_acc, best_step = val_acc, step
+            print("Best model upto now")
+            if save_dict is not None:
+                path = os.path.join(output_dir, 'IID_best.pkl')
+                torch.save(dict(save_dict, model_dict=model_dict), path + ".tmp")
+                os.replace(path + ".tmp", path)
+
+        last_results_keys = write_results(results, output_dir,
+                                          last_results_keys)
+        done.put((step, val_acc if full else None))
+
+
+class EvalWorker:
+    """
+    Evaluates weight snapshots in a separate process, so that training does
+    not pause at checkpoints. The worker builds its own copy of the
+    algorithm, rebuilds the dataset from `dataset_args` (see
+    `rebuild_dataset`) and the evaluation splits from `evals`, (name,
+    (environment index, keys), weights) tuples as returned by
+    `split_keys`, and evaluates them with a CheckpointEvaluator built from `evaluator_kwargs`. It writes the results
+    rows to results.jsonl and saves IID_best.pkl (if `save_dict` is given)
+    whenever a snapshot is the best so far.
+
+    `submit` copies the weights into pinned host buffers with asynchronous
+    copies and queues them from a background thread. At most `max_pending`
+    snapshots wait for evaluation; `submit` blocks beyond that.
+    """
+
+    def __init__(self, algorithm_class, algorithm_args, dataset_args, evals,
+                 device, output_dir, save_dict=None, best=(0, -1),
+                 max_pending=2, **evaluator_kwargs):
+        ctx = mp.get_context("spawn")
+        self._jobs = ctx.Queue(max_pending)
+        self._done = ctx.Queue()
+        self._snapshots = AsyncCheckpointWriter()
+        self._thread = None
+        self._error = None
+        self.best_val_acc, self.best_step = best
+        self._process = ctx.Process(
+            target=_worker_main,
+            args=(algorithm_class, algorithm_args, dataset_args, evals, device,
+                  evaluator_kwargs, output_dir, save_dict, best, self._jobs,
+                  self._done))
+        self._process.start()
+
+    def _wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, step, state_dict, results, final=False):
+        """Queue the weights of `step` for evaluation; the evaluation results
+        are added to `results` before it is written."""
+        if not self._process.is_alive():
+            raise RuntimeError("Evaluation worker exited with code {}".format(
+                self._process.exitcode))
+        self._wait()  # the previous job may still be reading the buffers
+        model_dict, event = self._snapshots.snapshot(state_dict)
+
+        def _put():
+            try:
+                if event is not None:
+                    event.synchronize()
+                # the buffers are reused by the next snapshot
+                job_dict = {k: v.clone() for k, v in model_dict.items()}
+                self._jobs.put((step, job_dict, results, final))
+            except Exception as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=_put, daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        """Fold the evaluations finished so far into the best accuracy."""
+        while True:
+            try:
+                step, val_acc = self._done.get_nowait()
+            except queue.Empty:
+                return
+            if is_better(val_acc, step, self.best_val_acc, self.best_step):
+                self.best_val_acc, self.best_step = val_acc, step
+
+    def close(self):
+        """Wait until every queued snapshot has been evaluated."""
+        self._wait()
+        self._jobs.put(None)
+        # drain the result queue, the worker cannot exit while it is full
+        while self._process.is_alive():
+            self.poll()
+            self._process.join(timeout=1)
+        self.poll()
+        if self._process.exitcode != 0:
+            raise RuntimeError("Evaluation worker exited with code {}".format(
+                self._process.exitcode))
@@ -1,28 +1,50 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
+import collections
+
 import torch
 
 class _InfiniteSampler(torch.utils.data.Sampler):
-    """Wraps another Sampler to yield an infinite stream."""
-    def __init__(self, sampler):
+    """Wraps another Sampler to yield an infinite stream, optionally skipping
+    its first `start_batch` batches (only the indices are drawn)."""
+    def __init__(self, sampler, start_batch=0):
         self.sampler = sampler
+        self.start_batch = start_batch
 
     def __iter__(self):
+        skip = self.start_batch
         while True:
             for batch in self.sampler:
+                if skip > 0:
+                    skip -= 1
+                    continue
                 yield batch
 
+def _generator(seed):
+    if seed is None:
+        return None
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
 class InfiniteDataLoader:
-    def __init__(self, dataset, weights, batch_size, num_workers):
+    """With a `seed`, the sampled indices only depend on the seed, and
+    `start_batch` resumes the index stream after that many batches."""
+    def __init__(self, dataset, weights, batch_size, num_workers,
+                 pin_memory=False, prefetch_factor=None, seed=None,
+                 start_batch=0):
         super().__init__()
 
+        generator = _generator(seed)
         if weights is not None:
             sampler = torch.utils.data.WeightedRandomSampler(weights,
                 replacement=True,
-                num_samples=batch_size)
+                num_samples=batch_size,
+                generator=generator)
         else:
             sampler = torch.utils.data.RandomSampler(dataset,
-                replacement=True)
+                replacement=True,
+                generator=generator)
 
         if weights == None:
             weights = torch.ones(len(dataset))
@@ -32,10 +54,17 @@ class InfiniteDataLoader:
             batch_size=batch_size,
             drop_last=True)
 
+        loader_kwargs = {}
+        if num_workers > 0 and prefetch_factor is not None:
+            loader_kwargs['prefetch_factor'] = prefetch_factor
+
         self._infinite_iterator = iter(torch.utils.data.DataLoader(
             dataset,
             num_workers=num_workers,
-            batch_sampler=_InfiniteSampler(batch_sampler)
+            batch_sampler=_InfiniteSampler(batch_sampler, start_batch),
+            pin_memory=pin_memory,
+            generator=generator,
+            **loader_kwargs
         ))
 
     def __iter__(self):
@@ -45,6 +74,79 @@ class InfiniteDataLoader:
     def __len__(self):
         raise ValueError
 
+class _MultiDomainBatchSampler(torch.utils.data.Sampler):
+    """Infinite batch sampler over a ConcatDataset: every batch holds
+    `batch_size` indices drawn with replacement from each domain, in domain
+    order."""
+    def __init__(self, lengths, weights, batch_size, generator=None):
+        self.lengths = lengths
+        self.weights = weights
+        self.batch_size = batch_size
+        self.generator = generator
+        self.offsets = [0]
+        for length in lengths[:-1]:
+            self.offsets.append(self.offsets[-1] + length)
+
+    def __iter__(self):
+        while True:
+            batch = []
+            for offset, length, weights in zip(self.offsets, self.lengths,
+                                               self.weights):
+                if weights is not None:
+                    idx = torch.multinomial(weights, self.batch_size,
+                                            replacement=True,
+                                            generator=self.generator)
+                else:
+                    idx = torch.randint(length, (self.batch_size,),
+                                        generator=self.generator)
+                batch += (idx + offset).tolist()
+            yield batch
+
+class MultiDomainInfiniteDataLoader:
+    """Drop-in replacement for `zip(*[InfiniteDataLoader(env) ...])` that
+    serves all domains from a single worker pool. Yields `[(x, y), ...]`
+    with one `batch_size` minibatch per domain. `seed` and `start_batch` are
+    as in InfiniteDataLoader."""
+    def __init__(self, datasets, weights, batch_size, num_workers,
+                 pin_memory=False, prefetch_factor=None, seed=None,
+                 start_batch=0):
+        super().__init__()
+
+        if weights is None:
+            weights = [None] * len(datasets)
+        weights = [None if w is None else torch.as_tensor(w, dtype=torch.double)
+                   for w in weights]
+
+        self._n_domains = len(datasets)
+        self._batch_size = batch_size
+
+        generator = _generator(seed)
+        batch_sampler = _MultiDomainBatchSampler(
+            [len(dataset) for dataset in datasets], weights, batch_size,
+            generator)
+
+        loader_kwargs = {}
+        if num_workers > 0 and prefetch_factor is not None:
+            loader_kwargs['prefetch_factor'] = prefetch_factor
+
+        self._infinite_iterator = iter(torch.utils.data.DataLoader(
+            torch.utils.data.ConcatDataset(datasets),
+            num_workers=num_workers,
+            batch_sampler=_InfiniteSampler(batch_sampler, start_batch),
+            pin_memory=pin_memory,
+            generator=generator,
+            **loader_kwargs
+        ))
+
+    def __iter__(self):
+        while True:
+            x, y = next(self._infinite_iterator)
+            yield list(zip(torch.split(x, self._batch_size),
+                           torch.split(y, self._batch_size)))
+
+    def __len__(self):
+        raise ValueError
+
 class FastDataLoader:
     """DataLoader wrapper with slightly improved speed by not respawning worker
     processes at every epoch."""
@@ -71,3 +173,59 @@ class FastDataLoader:
 
     def __len__(self):
         return self._length
+
+class DevicePrefetcher:
+    """Wraps an iterator of (nested lists/tuples of) tensors and keeps
+    `num_batches` of them already copied to `device`. On CUDA the copies are
+    issued on a side stream from pinned memory, so the copy for step N+1
+    overlaps with the compute of step N."""
+    def __init__(self, iterator, device, num_batches=1):
+        super().__init__()
+        self._iterator = iter(iterator)
+        self._device = torch.device(device)
+        self._num_batches = max(1, num_batches)
+        self._use_stream = self._device.type == "cuda"
+        self._stream = torch.cuda.Stream() if self._use_stream else None
+        self._queue = collections.deque()
+        for _ in range(self._num_batches):
+            self._preload()
+
+    def _to_device(self, obj):
+        if torch.is_tensor(obj):
+            return obj.to(self._device, non_blocking=self._use_stream)
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_device(o) for o in obj)
+        return obj
+
+    def _record_stream(self, obj):
+        if torch.is_tensor(obj):
+            obj.record_stream(torch.cuda.current_stream())
+        elif isinstance(obj, (list, tuple)):
+            for o in obj:
+                self._record_stream(o)
+
+    def _preload(self):
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            return
+        if self._use_stream:
+            with torch.cuda.stream(self._stream):
+                batch = self._to_device(batch)
+        else:
+            batch = self._to_device(batch)
+        self._queue.append(batch)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._queue:
+            raise StopIteration
+        if self._use_stream:
+            torch.cuda.current_stream().wait_stream(self._stream)
+        batch = self._queue.popleft()
+        if self._use_stream:
+            self._record_stream(batch)
+        self._preload()
+        return batch
@@ -0,0 +1,135 @@
+"""
+On-disk cache of decoded images for ImageFolder-style environments.
+
+Every image of an environment is decoded once, resized so that its short
+side equals `short_side`, and appended to a flat uint8 file that later runs
+memory-map. The cache records a hash of the environment manifest (relative
+path, size and mtime of every file) so it is rebuilt when the folder
+changes.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.datasets.folder import default_loader
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+from domainbed.lib.manifest import load_manifest
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/domainbed/images")
+
+
+def folder_hash(manifest, short_side):
+    """Hash of the file list, labels, sizes and mtimes recorded in
+    `manifest`."""
+    h = hashlib.md5()
+    h.update("{}:{}".format(CACHE_VERSION, short_side).encode("utf-8"))
+    h.update("\n".join(manifest.rel_paths.tolist()).encode("utf-8"))
+    for array in (manifest.labels, manifest.sizes, manifest.mtimes):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def _cache_prefix(root, cache_dir, short_side):
+    root = os.path.normpath(os.path.abspath(root))
+    name = hashlib.md5(root.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "{}_{}_{}".format(
+        os.path.basename(root), name, short_side))
+
+
+def _atomic_save(path, array):
+    tmp = path + ".tmp{}".format(os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def build_cache(root, samples, prefix, short_side, content_hash):
+    """Decode `samples` into `<prefix>.u8` plus index/label arrays and a
+    manifest. Files are written to temporaries and renamed into place, the
+    manifest last, so a partially built cache is never picked up."""
+    index = np.zeros((len(samples), 3), dtype=np.int64)  # offset, h, w
+    labels = np.zeros(len(samples), dtype=np.int64)
+
+    data_tmp = prefix + ".u8.tmp{}".format(os.getpid())
+    offset = 0
+    with open(data_tmp, "wb") as f:
+        for i, (path, label) in enumerate(samples):
+            image = TF.resize(default_loader(path), short_side,
+                              interpolation=InterpolationMode.BILINEAR)
+            array = np.asarray(image, dtype=np.uint8)
+            f.write(array.tobytes())
+            index[i] = (offset, array.shape[0], array.shape[1])
+            labels[i] = label
+            offset += array.size
+    os.replace(data_tmp, prefix + ".u8")
+
+    _atomic_save(prefix + "_index.npy", index)
+    _atomic_save(prefix + "_labels.npy", labels)
+
+    manifest_tmp = prefix + "_manifest.json.tmp{}".format(os.getpid())
+    with open(manifest_tmp, "w") as f:
+        json.dump({"version": CACHE_VERSION, "root": os.path.abspath(root),
+                   "short_side": short_side, "hash": content_hash,
+                   "length": len(samples), "nbytes": offset}, f)
+    os.replace(manifest_tmp, prefix + "_manifest.json")
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    """ImageFolder replacement that serves pre-decoded, pre-resized images
+    from a memory-mapped cache. Only `transform` (crop, flip, normalize...)
+    runs per sample."""
+
+    def __init__(self, root, cache_dir=None, short_side=256, transform=None,
+                 target_transform=None, manifest_dir=None):
+        super(CachedImageFolder, self).__init__()
+        cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        manifest = load_manifest(root, manifest_dir)
+        self.classes, self.class_to_idx = manifest.classes, manifest.class_to_idx
+        self.samples = manifest.samples
+
+        prefix = _cache_prefix(root, cache_dir, short_side)
+        content_hash = folder_hash(manifest, short_side)
+        manifest_path = prefix + "_manifest.json"
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        if manifest is None or manifest["hash"] != content_hash:
+            print("Building image cache for {} in {}".format(root, cache_dir))
+            build_cache(root, self.samples, prefix, short_side, content_hash)
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        self.index = np.load(prefix + "_index.npy")
+        self.targets = np.load(prefix + "_labels.npy").tolist()
+        self.data = np.memmap(prefix + ".u8", dtype=np.uint8, mode="r",
+                              shape=(manifest["nbytes"],))
+
+    def __len__(self):
+        return len(self.index)
+
+    def load_array(self, idx):
+        """Return image `idx` as a (H, W, 3) uint8 array view of the cache."""
+        offset, h, w = self.index[idx]
+        return self.data[offset: offset + h * w * 3].reshape(h, w, 3)
+
+    def __getitem__(self, idx):
+        image = Image.fromarray(np.array(self.load_array(idx)))
+        target = self.targets[idx]
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
@@ -0,0 +1,134 @@
+"""
+Persisted file manifests for ImageFolder-style environments.
+
+Scanning a large environment (e.g. DomainNet) walks and stats every file.
+The manifest stores the result of one scan, the relative path, label, size
+and mtime of every sample, as columnar arrays in a single `.npz`. It is
+reused for as long as the mtimes of the scanned directories are unchanged.
+Adding, removing or renaming a file updates the mtime of its directory.
+"""
+
+import hashlib
+import os
+import warnings
+
+import numpy as np
+from torchvision.datasets import ImageFolder
+from torchvision.datasets.folder import (
+    IMG_EXTENSIONS, find_classes, has_file_allowed_extension)
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST_DIR = os.path.expanduser("~/.cache/domainbed/manifests")
+
+
+class Manifest:
+    def __init__(self, root, classes, rel_paths, labels, sizes, mtimes,
+                 dirs, dir_mtimes):
+        self.root = root
+        self.classes = classes
+        self.class_to_idx = {cls: i for i, cls in enumerate(classes)}
+        self.rel_paths = rel_paths
+        self.labels = labels
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.dirs = dirs
+        self.dir_mtimes = dir_mtimes
+
+    @property
+    def samples(self):
+        return [(os.path.join(self.root, p), int(y))
+                for p, y in zip(self.rel_paths, self.labels)]
+
+    def is_valid(self):
+        try:
+            mtimes = [os.stat(os.path.join(self.root, d)).st_mtime_ns
+                      for d in self.dirs]
+        except OSError:
+            return False
+        return np.array_equal(np.asarray(mtimes, dtype=np.int64), self.dir_mtimes)
+
+
+def scan(root, extensions=IMG_EXTENSIONS):
+    """Walk `root` the same way torchvision's ImageFolder does and return a
+    Manifest of the result."""
+    classes, class_to_idx = find_classes(root)
+    rel_paths, labels, sizes, mtimes = [], [], [], []
+    dirs = ["."]
+    for target_class in sorted(class_to_idx.keys()):
+        target_dir = os.path.join(root, target_class)
+        if not os.path.isdir(target_dir):
+            continue
+        for dir_root, _, fnames in sorted(os.walk(target_dir, followlinks=True)):
+            dirs.append(os.path.relpath(dir_root, root))
+            for fname in sorted(fnames):
+                if has_file_allowed_extension(fname, extensions):
+                    path = os.path.join(dir_root, fname)
+                    st = os.stat(path)
+                    rel_paths.append(os.path.relpath(path, root))
+                    labels.append(class_to_idx[target_class])
+                    sizes.append(st.st_size)
+                    mtimes.append(st.st_mtime_ns)
+    dir_mtimes = [os.stat(os.path.join(root, d)).st_mtime_ns for d in dirs]
+    return Manifest(root, classes, np.asarray(rel_paths, dtype=str),
+                    np.asarray(labels, dtype=np.int64),
+                    np.asarray(sizes, dtype=np.int64),
+                    np.asarray(mtimes, dtype=np.int64),
+                    np.asarray(dirs, dtype=str),
+                    np.asarray(dir_mtimes, dtype=np.int64))
+
+
+def manifest_path(root, manifest_dir):
+    root = os.path.normpath(os.path.abspath(root))
+    name = hashlib.md5(root.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(manifest_dir, "{}_{}_v{}.npz".format(
+        os.path.basename(root), name, MANIFEST_VERSION))
+
+
+def load_manifest(root, manifest_dir=None):
+    """Return the manifest of `root`, rescanning only if the stored one is
+    missing or stale."""
+    path = manifest_path(root, manifest_dir or DEFAULT_MANIFEST_DIR)
+    if os.path.exists(path):
+        with np.load(path) as f:
+            manifest = Manifest(root, f["classes"].tolist(), f["rel_paths"],
+                                f["labels"], f["sizes"], f["mtimes"],
+                                f["dirs"], f["dir_mtimes"])
+        if manifest.is_valid():
+            return manifest
+
+    manifest = scan(root)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp{}.npz".format(os.getpid())
+        np.savez(tmp, classes=np.asarray(manifest.classes, dtype=str),
+                 rel_paths=manifest.rel_paths, labels=manifest.labels,
+                 sizes=manifest.sizes, mtimes=manifest.mtimes,
+                 dirs=manifest.dirs, dir_mtimes=manifest.dir_mtimes)
+        os.replace(tmp, path)
+    except OSError as e:
+        warnings.warn("Could not write manifest for {}: {}".format(root, e))
+    return manifest
+
+
+class ManifestImageFolder(ImageFolder):
+    """ImageFolder whose class list and samples come from a persisted
+    manifest instead of a directory walk."""
+
+    def __init__(self, root, manifest_dir=None, transform=None,
+                 target_transform=None):
+        self.manifest = load_manifest(root, manifest_dir)
+        super(ManifestImageFolder, self).__init__(
+            root, transform=transform, target_transform=target_transform)
+
+    def find_classes(self, directory):
+        return self.manifest.classes, self.manifest.class_to_idx
+
+    def make_dataset(self, directory, class_to_idx, extensions=None,
+                     is_valid_file=None, allow_empty=False, **kwargs):
+        # newer torchvision versions pass allow_empty (and may pass more)
+        samples = self.manifest.samples
+        if not samples and not allow_empty:
+            raise FileNotFoundError(
+                "Found no valid file for the classes {}.".format(
+                    ", ".join(sorted(class_to_idx))))
+        return samples
@@ -4,6 +4,7 @@
 Things that don't belong anywhere else
 """
 
+import contextlib
 import hashlib
 import json
 import os
@@ -95,8 +96,61 @@ class MovingAverage:
         self._updates += 1
         return ema_dict_data
 
+class MetricAccumulator:
+    """
+    Running means of the values returned by Algorithm.update(). Tensors are
+    summed on their own device, so nothing is synchronized until `reduce()`,
+    which copies all the sums of one device to the host at once.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = Counter()
+
+    def add(self, values):
+        for key, val in values.items():
+            if torch.is_tensor(val):
+                val = val.detach().float().mean()
+            self.sums[key] = self.sums[key] + val if key in self.sums else val
+            self.counts[key] += 1
+
+    def reduce(self):
+        means = {}
+        keys_by_device = defaultdict(list)
+        for key, val in self.sums.items():
+            if torch.is_tensor(val):
+                keys_by_device[val.device].append(key)
+            else:
+                means[key] = val / self.counts[key]
+        for keys in keys_by_device.values():
+            sums = torch.stack([self.sums[key] for key in keys]).tolist()
+            for key, val in zip(keys, sums):
+                means[key] = val / self.counts[key]
+        return means
+
+
+def dataset_targets(dataset):
+    """
+    Return the labels of a dataset as a 1-D int64 tensor without loading any
+    inputs, or None if the dataset does not expose them.
+    """
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        return dataset.tensors[1].view(-1).long()
+    for attr in ("targets", "labels"):
+        targets = getattr(dataset, attr, None)
+        if targets is not None:
+            return torch.as_tensor(np.asarray(targets)).view(-1).long()
+    return None
+
 
 def make_weights_for_balanced_classes(dataset):
+    targets = dataset_targets(dataset)
+    if targets is not None:
+        counts = torch.bincount(targets)
+        n_classes = int((counts > 0).sum())
+        weight_per_class = 1. / (counts.double() * n_classes)
+        return weight_per_class[targets].float()
+
     counts = Counter()
     classes = []
     for _, y in dataset:
@@ -163,9 +217,25 @@ class _SplitDataset(torch.utils.data.Dataset):
     def __getitem__(self, key):
         return self.underlying_dataset[self.keys[key]]
 
+    def __getitems__(self, keys):
+        """Batched reads (used by DataLoader), forwarded to the underlying
+        dataset's __getitems__ if it has one."""
+        keys = [self.keys[key] for key in keys]
+        if hasattr(self.underlying_dataset, '__getitems__'):
+            return self.underlying_dataset.__getitems__(keys)
+        return [self.underlying_dataset[key] for key in keys]
+
     def __len__(self):
         return len(self.keys)
 
+    @property
+    def targets(self):
+        """Labels of the split, resolved through the underlying dataset."""
+        targets = dataset_targets(self.underlying_dataset)
+        if targets is None:
+            return None
+        return targets[torch.as_tensor(self.keys, dtype=torch.long)]
+
 
 def split_dataset_PACS_Custom(dataset, n, seed=0):
     """
@@ -178,14 +248,7 @@ def split_dataset_PACS_Custom(dataset, n, seed=0):
     np.random.RandomState(seed).shuffle(keys)
     keys_1 = keys[:n]
     keys_2 = keys[n:]
-    subset_dataset_1 = copy.deepcopy(dataset)
-    subset_dataset_2 = copy.deepcopy(dataset)
-    subset_dataset_1.data = [subset_dataset_1.data[k1] for k1 in keys_1]
-    subset_dataset_1.targets = [subset_dataset_1.targets[k1] for k1 in keys_1]
-    subset_dataset_2.data = [subset_dataset_2.data[k1] for k1 in keys_2]
-    subset_dataset_2.targets = [subset_dataset_2.targets[k1] for k1 in keys_2]
-    
-    return subset_dataset_1, subset_dataset_2
+    return dataset.subset(keys_1), dataset.subset(keys_2)
 
 def split_dataset(dataset, n, seed=0):
     """
@@ -217,10 +280,25 @@ def random_pairs_of_minibatches(minibatches):
 
     return pairs
 
+def _weighted_correct(p, y, batch_weights=None):
+    """Number of correct predictions in a batch, weighted by
+    `batch_weights` if given, as a device tensor."""
+    if len(p.shape)==1:
+        p = p.reshape(1,-1)
+    if p.size(1) == 1:
+        correct = p.gt(0).eq(y).float()
+        if batch_weights is not None:
+            correct = correct * batch_weights.view(-1, 1)
+    else:
+        correct = p.argmax(1).eq(y).float()
+        if batch_weights is not None:
+            correct = correct * batch_weights
+    return correct.sum()
+
 def average_accuracy(x,y,network,batch_weights,times=1):
 
-    loss=[]
-    acc=[]
+    loss = 0
+    acc = 0
     with torch.no_grad():
         for i in range(times):
             if hasattr(network,'randConv_Op'):
@@ -244,77 +322,67 @@ def average_accuracy(x,y,network,batch_weights,times=1):
             # clip_max = network.clip_max.to('cuda')
             # img = torch.clamp(img,clip_min,clip_max)
             # p = network.predict(img)
-            loss.append(F.cross_entropy(p, y).item()/times)
-            if len(p.shape)==1:
-                p = p.reshape(1,-1)
-            if p.size(1) == 1:
-                # if p.size(1) == 1:
-                acc.append((p.gt(0).eq(y).float() * batch_weights.view(-1, 1)).sum().item())
-            else:
-                # print('p hai ye', p.size(1))
-                acc.append((p.argmax(1).eq(y).float() * batch_weights).sum().item())
+            loss = loss + F.cross_entropy(p, y)/times
+            acc = acc + _weighted_correct(p, y, batch_weights)/times
     
-    return np.sum(loss), np.mean(acc)
+    return loss, acc
             
 
 
 
-def accuracy(network, loader, weights, device,val_id,current_id,randconv=False,noise_sd=0.5,addnoise=False):
-    correct = 0
+def accuracy(network, loader, weights, device,val_id,current_id,randconv=False,noise_sd=0.5,addnoise=False,batch_augment=None):
+    """
+    Weighted accuracy and mean batch loss of `network` on `loader`. Sums are
+    kept on the device and copied to the host once at the end. Predictions
+    run under the algorithm's mixed-precision setting (hparams['amp']).
+    """
+    correct = torch.zeros((), dtype=torch.float64, device=device)
+    loss = torch.zeros((), dtype=torch.float64, device=device)
     total = 0
+    n_batches = 0
     weights_offset = 0
-    loss = []
+    if weights is not None:
+        weights = torch.as_tensor(weights).to(device)
+        total = weights.new_zeros((), dtype=torch.float64)
+    use_randconv = val_id == current_id and randconv
+    autocast = getattr(network, 'autocast', contextlib.nullcontext)
 
     network.eval()
-    with torch.no_grad():
+    # RandConv re-creates its conv layer during evaluation, which is not
+    # allowed in inference mode
+    with (torch.no_grad() if use_randconv else torch.inference_mode()):
         for x, y in loader:
             x = x.to(device)
             y = y.to(device)
+            if batch_augment is not None and x.dtype == torch.uint8:
+                x = batch_augment(x)
             if(addnoise):
                 x=x + torch.randn_like(x, device='cuda') * noise_sd
-            # network.randomize_kernel()
-            # network.randomize()
-            # network.rand_conv_module_cuda()
-            # p = network.predict(x)
-            # loss.append(F.cross_entropy(p, y).item())
             
             if weights is None:
-                batch_weights = torch.ones(len(x))
+                batch_weights = None
+                total += len(x)
             else:
                 batch_weights = weights[weights_offset: weights_offset + len(x)]
                 weights_offset += len(x)
-            batch_weights = batch_weights.to(device)
-            
-            # if len(p.shape)==1:
-            #     p = p.reshape(1,-1)
-            # if p.size(1) == 1:
-
-            #     # if p.size(1) == 1:
-            #     correct += (p.gt(0).eq(y).float() * batch_weights.view(-1, 1)).sum().item()
-            # else:
-            #     # print('p hai ye', p.size(1))
-            #     correct += (p.argmax(1).eq(y).float() * batch_weights).sum().item()
-
-            if val_id == current_id and randconv:
-                los, corr = average_accuracy(x,y,network,batch_weights,times=1)
-                loss.append(los)
-                correct+=corr
-            else:
-                p = network.predict(x)
-                loss.append(F.cross_entropy(p, y).item())
-                if len(p.shape)==1:
-                    p = p.reshape(1,-1)
-                if p.size(1) == 1:
+                total += batch_weights.sum()
 
-                    # if p.size(1) == 1:
-                    correct += (p.gt(0).eq(y).float() * batch_weights.view(-1, 1)).sum().item()
-                else:
-                    # print('p hai ye', p.size(1))
-                    correct += (p.argmax(1).eq(y).float() * batch_weights).sum().item()
-            total += batch_weights.sum().item()
+            if use_randconv:
+                with autocast():
+                    los, corr = average_accuracy(x,y,network,batch_weights,times=1)
+            else:
+                with autocast():
+                    p = network.predict(x)
+                los = F.cross_entropy(p.float(), y)
+                corr = _weighted_correct(p, y, batch_weights)
+            loss += los
+            correct += corr
+            n_batches += 1
     network.train()
+    correct, loss, total = torch.stack(
+        [correct, loss, torch.as_tensor(total, dtype=torch.float64, device=device)]).tolist()
     #print("Correct",correct,"loss",loss)
-    return correct / total, np.mean(loss)
+    return correct / total, loss / max(n_batches, 1)
 
 
 def two_model_analysis(network,network_comp, loader, weights, device,noise_sd=0.5,addnoise=False,env_name="env0"):
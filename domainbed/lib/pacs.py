@@ -1,4 +1,6 @@
+import copy
 import os
+import numpy as np
 from PIL import Image
 from torchvision import transforms
 from torchvision.datasets import VisionDataset
@@ -16,21 +18,38 @@ class PACSDataset(VisionDataset):
         
 
     def load_images(self):
+        """Index the image paths; images are decoded lazily in __getitem__."""
         images, targets = [],[]
         for cls in self.classes:
             class_dir = os.path.join(self.root_dir, cls)
             for image_name in os.listdir(class_dir):
-                image = Image.open(os.path.join(class_dir, image_name)).convert('RGB')
                 label = self.class_to_idx[cls]
-                images.append(image)
+                images.append(os.path.join(class_dir, image_name))
                 targets.append(label)
         return images, targets
 
+    def subset(self, keys):
+        """Return a view on `keys` that shares this dataset's paths and
+        transforms. Costs O(len(keys)), no image data is copied."""
+        view = copy.copy(self)
+        view.data = [self.data[k] for k in keys]
+        view.targets = [self.targets[k] for k in keys]
+        # like misc._SplitDataset, so the split can be rebuilt from its keys
+        view.underlying_dataset, view.keys = self, list(keys)
+        return view
+
+    def load_image(self, item):
+        if isinstance(item, str):
+            return Image.open(item).convert('RGB')
+        if isinstance(item, np.ndarray):
+            return Image.fromarray(item)
+        return item
+
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        image, label = self.data[idx], self.targets[idx]
+        image, label = self.load_image(self.data[idx]), self.targets[idx]
         if self.transform:
             image = self.transform(image)
         return image, label
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+torch.profiler capture of a window of training steps or evaluation passes.
+
+Outside the window, `WindowProfiler(step)` returns a null context, so a
+run without --profile_steps/--profile_eval_steps pays nothing.
+"""
+
+import contextlib
+import os
+
+import torch
+
+
+def parse_window(window):
+    """"START:END" -> (START, END), covering steps START <= step < END."""
+    if not window:
+        return None
+    start, end = window.split(":")
+    start, end = int(start), int(end)
+    if end <= start:
+        raise ValueError("Empty profiling window: {}".format(window))
+    return start, end
+
+
+class WindowProfiler:
+    """
+    Profiles the code run inside `profiler(step)` for every step in
+    `window`, recording shapes, memory and stack traces. When the window
+    closes, a Chrome trace (`profile_<name>_<first>-<last>.json`) and an
+    operator summary sorted by self time (`.txt`) are written to
+    `output_dir`.
+
+    With `per_call`, every call is exported separately (used for
+    evaluation passes, which are far apart).
+    """
+
+    def __init__(self, window, output_dir, name, per_call=False):
+        self.window = window
+        self.output_dir = output_dir
+        self.name = name
+        self.per_call = per_call
+        self._prof = None
+        self._first = self._last = None
+
+    def __call__(self, step):
+        if self.window is None or not (self.window[0] <= step < self.window[1]):
+            return contextlib.nullcontext()
+        return self._profile(step)
+
+    @contextlib.contextmanager
+    def _profile(self, step):
+        if self._prof is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._prof = torch.profiler.profile(
+                activities=activities, record_shapes=True,
+                profile_memory=True, with_stack=True)
+            self._prof.__enter__()
+            self._first = step
+        self._last = step
+        with torch.profiler.record_function("{}_step{}".format(self.name, step)):
+            yield
+        if self.per_call or step == self.window[1] - 1:
+            self.close()
+
+    def close(self):
+        """Stop profiling (if running) and write the trace and summary."""
+        if self._prof is None:
+            return
+        prof, self._prof = self._prof, None
+        prof.__exit__(None, None, None)
+
+        path = os.path.join(self.output_dir, "profile_{}_{}-{}".format(
+            self.name, self._first, self._last))
+        prof.export_chrome_trace(path + ".json")
+        sort_by = ("self_cuda_time_total" if torch.cuda.is_available()
+                   else "self_cpu_time_total")
+        with open(path + ".txt", "w") as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+            f.write("\n\nBy input shape:\n")
+            f.write(prof.key_averages(group_by_input_shape=True).table(
+                sort_by=sort_by, row_limit=50))
+            f.write("\n\nBy call stack:\n")
+            f.write(prof.key_averages(group_by_stack_n=5).table(
+                sort_by=sort_by, row_limit=50))
+        print("Profile written to", path + ".json")
@@ -0,0 +1,88 @@
+"""
+Batched random convolutions (RandConv) with a random filter per sample.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchRandConv(nn.Module):
+    """
+    Applies an independent random convolution to every sample (or to every
+    `group_size` consecutive samples) of a batch in a single grouped
+    convolution. The kernel size of every filter is drawn from
+    `kernel_sizes`; smaller kernels are zero-padded to the largest size,
+    which gives the same output as the smaller kernel with "same" padding.
+
+    Filters are drawn like the kaiming_normal_ init of RandConv's nn.Conv2d
+    (std 1 / sqrt(C * k * k)) into a preallocated weight buffer. With
+    `depthwise`, every channel is convolved with its own k x k filter
+    (groups=C in nn.Conv2d, std 1 / k) instead of mixing channels. With
+    `alpha_range`, outputs are mixed with the input with a per-sample alpha
+    (rounded to 0.1); with `identity_prob`, samples are left unchanged with
+    that probability; outputs are clamped to [clip_min, clip_max] if given.
+    """
+
+    def __init__(self, channels, kernel_sizes, group_size=1, identity_prob=0.,
+                 alpha_range=None, clip_min=None, clip_max=None,
+                 depthwise=False):
+        super(BatchRandConv, self).__init__()
+        self.channels = channels
+        self.depthwise = depthwise
+        self.kernel_sizes = sorted(kernel_sizes)
+        self.max_size = self.kernel_sizes[-1]
+        self.group_size = group_size
+        self.identity_prob = identity_prob
+        self.alpha_range = alpha_range
+        self.register_buffer("clip_min", clip_min, persistent=False)
+        self.register_buffer("clip_max", clip_max, persistent=False)
+        self.register_buffer("weight", torch.empty(0), persistent=False)
+
+        # std times the centre mask of every kernel size, (n_sizes, K, K)
+        offset = (torch.arange(self.max_size) - self.max_size // 2).abs()
+        offset = torch.maximum(offset.view(-1, 1), offset.view(1, -1))
+        fan_in = 1 if depthwise else channels
+        scales = torch.stack([(offset <= ks // 2).float() / math.sqrt(fan_in * ks * ks)
+                              for ks in self.kernel_sizes])
+        self.register_buffer("scales", scales, persistent=False)
+
+    @torch.no_grad()
+    def randomize(self, n):
+        """Draw the filters for a batch of `n` samples."""
+        n_kernels = -(-n // self.group_size)
+        size = self.max_size
+        in_channels = 1 if self.depthwise else self.channels
+        shape = (n_kernels, self.channels, in_channels, size, size)
+        if self.weight.shape != shape:
+            self.weight = torch.empty(shape, device=self.scales.device)
+        size_ids = torch.randint(len(self.kernel_sizes), (n_kernels,),
+                                 device=self.scales.device)
+        self.weight.normal_().mul_(
+            self.scales[size_ids].view(n_kernels, 1, 1, size, size))
+
+    @torch.no_grad()
+    def forward(self, x):
+        n, c, h, w = x.shape
+        size = self.max_size
+        self.randomize(n)
+        weight = self.weight
+        if self.group_size > 1:
+            weight = weight.repeat_interleave(self.group_size, dim=0)[:n]
+        in_channels = 1 if self.depthwise else c
+        out = F.conv2d(x.reshape(1, n * c, h, w),
+                       weight.reshape(n * c, in_channels, size, size),
+                       padding=size // 2, groups=n * c // in_channels).view(n, c, h, w)
+
+        if self.alpha_range is not None:
+            alpha = torch.empty(n, 1, 1, 1, device=x.device).uniform_(*self.alpha_range)
+            alpha = (alpha * 10).round() / 10
+            out = alpha * out + (1 - alpha) * x
+        if self.identity_prob > 0:
+            keep = torch.rand(n, 1, 1, 1, device=x.device) < self.identity_prob
+            out = torch.where(keep, x, out)
+        if self.clip_min is not None:
+            out = torch.clamp(out, self.clip_min, self.clip_max)
+        return out
@@ -193,6 +193,10 @@ class T2T_ViT(nn.Module):
 
 
 class TokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
+    # forward draws random layers on the host, networks.compile_network
+    # compiles the submodules and keeps this forward eager
+    COMPILE_PER_CHILD = True
+
     def __init__(self, num_layers=1, d_rate=0.5, alpha=0.1, first_layers_to_choose=0.7, **kwargs):
         super().__init__(**kwargs)
         print('--- init the TokenLevelFeatureStylization_T2T_VIT')
@@ -214,14 +218,13 @@ class TokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
 
         split_point = int(self.d_rate * x.shape[1])
         x_augmented = self.feature_stylization(x)
-        d0_indices, d1_indices = np.indices(x.shape[:2])
+        d0_indices = torch.arange(x.shape[0], device=x.device)[:, None]
 
-        # independently shuffle the patch indexes
-        for i in d1_indices:
-            np.random.shuffle(i)
+        # independently shuffle the patch indexes (on the device)
+        d1_indices = torch.rand(x.shape[:2], device=x.device).argsort(dim=1)
 
-        x[d0_indices[:, :split_point], d1_indices[:, :split_point]] = x_augmented[
-            d0_indices[:, :split_point], d1_indices[:, :split_point]]
+        x[d0_indices, d1_indices[:, :split_point]] = x_augmented[
+            d0_indices, d1_indices[:, :split_point]]
 
         return x
 
@@ -257,6 +260,10 @@ class TokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
 
 
 class AttentionBasedTokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
+    # forward draws random layers on the host, networks.compile_network
+    # compiles the submodules and keeps this forward eager
+    COMPILE_PER_CHILD = True
+
     def __init__(self, num_layers=1, d_rate=0.5, alpha=0.1, first_layers_to_choose=0.7, **kwargs):
         super().__init__(**kwargs)
         print('+++ init the AttentionBasedTokenLevelFeatureStylization_T2T_VIT')
@@ -283,7 +290,7 @@ class AttentionBasedTokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
 
         x_augmented = self.feature_stylization(x)
 
-        d0_indices, _ = np.indices(attention_maps.shape[:2])
+        d0_indices = torch.arange(attention_maps.shape[0], device=x.device)[:, None]
 
         d1_indices = torch.argsort(attention_maps, descending=True, dim=-1)  # att_sorted_indices  => most important (big values) first
         d1_indices = d1_indices + 1 # we won't replace the cls token
@@ -291,7 +298,7 @@ class AttentionBasedTokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
         ## debug
         # x_org = torch.clone(x)
 
-        x[d0_indices[:, :split_point], d1_indices[:, :split_point]] = x_augmented[d0_indices[:, :split_point], d1_indices[:, :split_point]]
+        x[d0_indices, d1_indices[:, :split_point]] = x_augmented[d0_indices, d1_indices[:, :split_point]]
 
         return x
 
@@ -332,6 +339,10 @@ class AttentionBasedTokenLevelFeatureStylization_T2T_VIT(T2T_ViT):
 
 
 class T2T_ViT_RB(nn.Module):
+    # forward draws random layers on the host, networks.compile_network
+    # compiles the submodules and keeps this forward eager
+    COMPILE_PER_CHILD = True
+
     def __init__(self, img_size=224, tokens_type='performer', in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., norm_layer=nn.LayerNorm, token_dim=64):
@@ -420,6 +431,9 @@ class FeatureStylization(nn.Module):
       https://github.com/KaiyangZhou/mixstyle-release
     """
 
+    # mixes feature statistics across the samples of a batch
+    BATCH_COUPLED = True
+
     def __init__(self, alpha=0.1, eps=1e-6):
         """
         Args:
@@ -452,7 +466,7 @@ class FeatureStylization(nn.Module):
         lmda = self.beta.sample((B, 1, 1))
         lmda = lmda.to(x.device)
 
-        perm = torch.randperm(B)
+        perm = torch.randperm(B, device=x.device)
 
         mu2, sig2 = mu[perm], sig[perm]
         mu_mix = mu * lmda + mu2 * (1 - lmda)
@@ -0,0 +1,94 @@
+"""
+Lightweight per-phase timing of the training loop.
+
+The training loop and the algorithms annotate phases with
+
+    with timing.phase("backward"):
+        loss.backward()
+
+which does nothing unless a PhaseTimer has been activated. On CUDA, device
+phases are measured with CUDA events recorded on the current stream, so
+timing does not synchronize the host; the events are resolved when they
+have completed, or at the latest in `summary()`. Host phases (e.g. waiting
+for data) use `device=False` and are measured with a host clock.
+
+The forward/backward/optimizer_step phases of update() are recorded by
+Algorithm.forward_pass, Algorithm.backward and Algorithm.optimizer_step,
+so algorithms that bypass them (e.g. hand-made gradients in Fish, MLDG or
+TRM) have no such breakdown.
+"""
+
+import contextlib
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+_active = None
+
+
+class PhaseTimer:
+    def __init__(self, device="cpu", max_pending=256):
+        self.use_events = torch.device(device).type == "cuda"
+        self.max_pending = max_pending
+        self._times = defaultdict(list)
+        self._pending = []
+
+    def activate(self):
+        """Make `timing.phase` record into this timer."""
+        global _active
+        _active = self
+        return self
+
+    @contextlib.contextmanager
+    def phase(self, name, device=True):
+        if device and self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self._pending.append((name, start, end))
+                if len(self._pending) >= self.max_pending:
+                    self._resolve(block=False)
+        else:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._times[name].append(time.perf_counter() - start)
+
+    def _resolve(self, block):
+        pending = []
+        for name, start, end in self._pending:
+            if block:
+                end.synchronize()
+            elif not end.query():
+                pending.append((name, start, end))
+                continue
+            self._times[name].append(start.elapsed_time(end) / 1000.)
+        self._pending = pending
+
+    def summary(self):
+        """Mean and percentiles (seconds) of every phase since the last
+        summary, as `time_<phase>_<stat>` keys."""
+        self._resolve(block=True)
+        results = {}
+        for name, times in self._times.items():
+            p50, p90, p99 = np.percentile(times, [50, 90, 99])
+            results['time_{}_mean'.format(name)] = float(np.mean(times))
+            results['time_{}_p50'.format(name)] = float(p50)
+            results['time_{}_p90'.format(name)] = float(p90)
+            results['time_{}_p99'.format(name)] = float(p99)
+        self._times = defaultdict(list)
+        return results
+
+
+def phase(name, device=True):
+    """Time the enclosed block as phase `name` in the active PhaseTimer."""
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.phase(name, device)
@@ -27,9 +27,10 @@ class SelectionMethod:
     def hparams_accs(self, records):
         """
         Given all records from a single (dataset, algorithm, test env) pair,
-        return a sorted list of (run_acc, records) tuples.
+        return a sorted list of (run_acc, records) tuples. Checkpoints that
+        were evaluated on a subsample (--eval_subsample) are ignored.
         """
-
+        records = records.filter(lambda r: not r.get('eval_subsample', 0))
         return (records.group('args.hparams_seed')
             .map(lambda _, run_records:
                 (
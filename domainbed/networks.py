@@ -1,4 +1,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import os
 import timm
 import torch
 import torch.nn as nn
@@ -279,6 +280,58 @@ def Classifier(in_features, out_features, is_nonlinear=False):
         return torch.nn.Linear(in_features, out_features)
 
 
+def _compile_forward(module):
+    # set as an instance attribute, so parameter names (and checkpoints) are
+    # the same as for the eager module
+    module.forward = torch.compile(module.forward)
+
+
+def compile_network(network):
+    """torch.compile the forward of `network` in place. Networks with
+    COMPILE_PER_CHILD (random host-side control flow in forward) keep their
+    forward eager and compile every submodule that has parameters instead,
+    so the random branches never break or re-specialize a graph."""
+    if not getattr(network, 'COMPILE_PER_CHILD', False):
+        _compile_forward(network)
+        return
+    for child in network.children():
+        modules = child if isinstance(child, nn.ModuleList) else [child]
+        for module in modules:
+            if next(module.parameters(), None) is not None:
+                _compile_forward(module)
+
+
+def compile_algorithm(algorithm):
+    """Compile the featurizer and classifier of `algorithm` (or its network
+    if it has none) when hparams['compile'] is set. With
+    hparams['compile_cache_dir'], the compiled kernels are cached in a
+    directory per backbone, shared by every job of a sweep."""
+    hparams = algorithm.hparams
+    if not hparams.get('compile', False):
+        return
+    if not algorithm.SUPPORTS_COMPILE:
+        print("{} does not support compile, running eagerly".format(
+            type(algorithm).__name__))
+        return
+    cache_dir = hparams.get('compile_cache_dir', " ")
+    if cache_dir != " ":
+        backbone = hparams['backbone']
+        if backbone == "ResNet" and hparams['resnet18']:
+            backbone = "ResNet18"
+        cache_dir = os.path.join(cache_dir, backbone)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR",
+                              os.path.join(cache_dir, "inductor"))
+        os.environ.setdefault("TRITON_CACHE_DIR",
+                              os.path.join(cache_dir, "triton"))
+    if hasattr(algorithm, 'featurizer') and hasattr(algorithm, 'classifier'):
+        compile_network(algorithm.featurizer)
+        compile_network(algorithm.classifier)
+    elif hasattr(algorithm, 'network'):
+        compile_network(algorithm.network)
+    else:
+        print("Nothing to compile for", type(algorithm).__name__)
+
+
 class WholeFish(nn.Module):
     def __init__(self, input_shape, num_classes, hparams, weights=None):
         super(WholeFish, self).__init__()
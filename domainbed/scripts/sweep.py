@@ -201,7 +201,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run a sweep')
 
     ### bash
-    parser.add_argument('command', choices=['launch', 'delete_incomplete', 'do_nothing'])
+    parser.add_argument('command', choices=['launch', 'delete_incomplete',
+        'resume_incomplete', 'do_nothing'])
     parser.add_argument('--datasets', nargs='+', type=str, default=DATASETS)
     parser.add_argument('--algorithms', nargs='+', type=str, default=algorithms.ALGORITHMS)
     parser.add_argument('--single_test_envs', action='store_true')
@@ -279,6 +280,15 @@ if __name__ == "__main__":
             ask_for_confirmation()
         Job.delete(to_delete)
 
+    elif args.command == 'resume_incomplete':
+        # train.py resumes from model_step_last.pkl in the job's output_dir
+        to_resume = [j for j in jobs if j.state == Job.INCOMPLETE]
+        print(f'About to resume {len(to_resume)} jobs.')
+        if not args.skip_confirmation:
+            ask_for_confirmation()
+        launcher_fn = command_launchers.REGISTRY[args.command_launcher]
+        Job.launch(to_resume, launcher_fn)
+
     elif args.command == 'do_nothing':
         print("Doing Nothing....")
 
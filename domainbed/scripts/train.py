@@ -23,10 +23,20 @@ import torch.nn as nn
 from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms
+from domainbed import networks
 from domainbed.lib import misc
-from domainbed.lib.fast_data_loader import InfiniteDataLoader, FastDataLoader
+from domainbed.lib.fast_data_loader import (
+    InfiniteDataLoader, MultiDomainInfiniteDataLoader, FastDataLoader,
+    DevicePrefetcher)
 from domainbed import model_selection
 from domainbed.lib.query import Q
+from domainbed.lib import timing
+from domainbed.lib.timing import PhaseTimer
+from domainbed.lib.profiling import WindowProfiler, parse_window
+from domainbed.lib.checkpoint import (
+    AsyncCheckpointWriter, get_rng_state, set_rng_state, load_model_dict)
+from domainbed.lib.evaluation import (
+    CheckpointEvaluator, EvalWorker, is_better, split_keys, write_results)
 from torchvision import transforms
 
 import os
@@ -78,7 +88,8 @@ def load_algorithm(file_path,hparams):
 
     return model, args, hparams
 
-def ME_ADA_AUGMENT(in_splits, algorithm, device, N_WORKERS, hparams, args):
+def ME_ADA_AUGMENT(in_splits, algorithm, device, N_WORKERS, hparams, args,
+                   seed=None):
 
     if len(in_splits) != 1:
         raise ValueError("The list must contain exactly one element.")
@@ -123,24 +134,56 @@ def ME_ADA_AUGMENT(in_splits, algorithm, device, N_WORKERS, hparams, args):
 
         labels += [x.item() for x in torch.unbind(targets1,dim=0)]
     
-    in_splits[0][0].data = np.concatenate([in_splits[0][0].data,images])
+    in_splits[0][0].data = list(in_splits[0][0].data) + images
     in_splits[0][0].targets.extend(labels)
     print("New dataset size ",len(in_splits[0][0].data))
     in_splits[0][0].transform = default_transform
 
-    train_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=N_WORKERS)
-        for i, (env, env_weights) in enumerate(in_splits)
-        if i not in args.test_envs]
-    
-    train_minibatches_iterator = zip(*train_loaders)
+    train_minibatches_iterator = train_minibatches(
+        [(algorithm.train_env(env), w) for env, w in in_splits], hparams,
+        N_WORKERS, device, args, seed)
     algorithm.train() 
 
     return in_splits, train_minibatches_iterator
 
+def train_minibatches(in_splits, hparams, N_WORKERS, device, args, seed=None,
+                      start_batch=0):
+    """Return an infinite iterator of [(x, y), ...] minibatches, one per
+    training environment. With a `seed`, the iterator resumes after
+    `start_batch` minibatches."""
+    train_envs = [(env, env_weights)
+        for i, (env, env_weights) in enumerate(in_splits)
+        if i not in args.test_envs]
+    pin_memory = args.prefetch_batches > 0 and device == "cuda"
+
+    if args.shared_loader:
+        minibatches_iterator = iter(MultiDomainInfiniteDataLoader(
+            datasets=[env for env, _ in train_envs],
+            weights=[env_weights for _, env_weights in train_envs],
+            batch_size=hparams['batch_size'],
+            num_workers=N_WORKERS,
+            pin_memory=pin_memory,
+            prefetch_factor=args.prefetch_factor,
+            seed=seed,
+            start_batch=start_batch))
+    else:
+        minibatches_iterator = zip(*[InfiniteDataLoader(
+            dataset=env,
+            weights=env_weights,
+            batch_size=hparams['batch_size'],
+            num_workers=N_WORKERS,
+            pin_memory=pin_memory,
+            prefetch_factor=args.prefetch_factor,
+            seed=None if seed is None else seed + i,
+            start_batch=start_batch)
+            for i, (env, env_weights) in enumerate(train_envs)])
+
+    if args.prefetch_batches > 0:
+        # device copies for the next step are issued while update() runs
+        minibatches_iterator = DevicePrefetcher(
+            minibatches_iterator, device, args.prefetch_batches)
+    return minibatches_iterator
+
 def ME_ADA_STEP(in_splits, epoch, final_epoch, batch_size, step):
 
     unfinished_epochs = final_epoch-(epoch+1)
@@ -180,6 +223,41 @@ if __name__ == "__main__":
     parser.add_argument('--skip_model_save', action='store_true')
     parser.add_argument('--save_model_every_checkpoint', action='store_true')
     parser.add_argument('--save_best_model', action='store_true')
+    parser.add_argument('--prefetch_batches', type=int, default=0,
+                        help='Number of minibatches staged on the device ahead '
+                             'of update() (0 disables prefetching).')
+    parser.add_argument('--prefetch_factor', type=int, default=None,
+                        help='Batches loaded in advance by each loader worker.')
+    parser.add_argument('--shared_loader', action='store_true',
+                        help='Serve all training domains from one worker pool '
+                             'instead of one DataLoader per domain.')
+    parser.add_argument('--sync_metrics', action='store_true',
+                        help='Copy the values returned by update() to the '
+                             'host at every step (for debugging). Only then '
+                             'does step_time include the device time of the '
+                             'step.')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Evaluate checkpoints in a separate process '
+                             'while training continues.')
+    parser.add_argument('--eval_subsample', type=int, default=0,
+                        help='Evaluate intermediate checkpoints on a fixed '
+                             'subset of this many samples per environment '
+                             '(0 evaluates everything).')
+    parser.add_argument('--eval_selection_envs', action='store_true',
+                        help='Skip the env{i}_in splits of the training '
+                             'environments, which model selection ignores.')
+    parser.add_argument('--time_phases', action='store_true',
+                        help='Record per-phase step times (data wait, copy, '
+                             'forward, backward, ...) in results.jsonl.')
+    parser.add_argument('--profile_steps', type=str, default=None,
+                        help='START:END window of update() calls to capture '
+                             'with torch.profiler.')
+    parser.add_argument('--profile_eval_steps', type=str, default=None,
+                        help='START:END window of checkpoint steps whose '
+                             'evaluation is captured with torch.profiler.')
+    parser.add_argument('--restart', action='store_true',
+                        help='Train from scratch even if output_dir holds a '
+                             'resumable checkpoint.')
     
 
 
@@ -246,6 +324,9 @@ if __name__ == "__main__":
     print('device:', device)
     print ('Current cuda device ', torch.cuda.current_device())
 
+    # the datasets add to hparams; the evaluation worker rebuilds the dataset
+    # from the hparams it was built with
+    dataset_hparams = copy.deepcopy(hparams)
     if args.dataset in vars(datasets):
         dataset = vars(datasets)[args.dataset](args.data_dir,
                                                args.test_envs, hparams)
@@ -271,6 +352,12 @@ if __name__ == "__main__":
 
     
     algorithm.to(device)
+    if hparams['amp'] != " " and not algorithm.SUPPORTS_AMP:
+        print("{} does not support mixed precision, training in fp32".format(
+            args.algorithm))
+    networks.compile_algorithm(algorithm)
+    if dataset.batch_augment is not None:
+        dataset.batch_augment.to(device)
 
     in_splits = []
     out_splits = []
@@ -349,19 +436,38 @@ if __name__ == "__main__":
                 print("env ",i," : ",envs_d[i]," out ",len(out_splits[i][0]))
     
 
-    train_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
-        for i, (env, env_weights) in enumerate(in_splits)
-        if i not in args.test_envs]
+    # Resume an interrupted run from the training state of its last checkpoint
+    resume_path = os.path.join(args.output_dir, 'model_step_last.pkl')
+    training_state = None
+    if not args.restart and os.path.exists(resume_path):
+        checkpoint = torch.load(resume_path, map_location="cpu")
+        training_state = checkpoint.get("training_state")
+    if training_state is not None:
+        loop_state = training_state["loop"]
+        print("Resuming from step", loop_state["step"])
+        load_model_dict(algorithm, checkpoint["model_dict"])
+        algorithm.load_training_state_dict(training_state["optimizers"])
+        for key in ["epoch", "total_steps"]:
+            if key in checkpoint["model_hparams"]:
+                hparams[key] = checkpoint["model_hparams"][key]
+        for k in range(loop_state["ME_ADA_k"]):
+            augmented = torch.load(os.path.join(args.output_dir,
+                                                f'me_ada_augment{k}.pkl'))
+            in_splits[0][0].data = list(in_splits[0][0].data) + augmented["data"]
+            in_splits[0][0].targets.extend(augmented["targets"])
+        del checkpoint
+    else:
+        loop_state = None
 
     uda_loaders = [InfiniteDataLoader(
         dataset=env,
         weights=env_weights,
         batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
+        num_workers=dataset.N_WORKERS,
+        pin_memory=args.prefetch_batches > 0 and device == "cuda",
+        prefetch_factor=args.prefetch_factor,
+        seed=misc.seed_hash(args.seed, 'uda', i),
+        start_batch=loop_state["step"] if loop_state else 0)
         for i, (env, env_weights) in enumerate(uda_splits)
         if i in args.test_envs]
 
@@ -371,17 +477,9 @@ if __name__ == "__main__":
     #     num_workers=dataset.N_WORKERS)
     #     for env, _ in (in_splits + out_splits + uda_splits)]
     if hparams['custom_train_val']:
-        eval_loaders = [FastDataLoader(
-            dataset=env,
-            batch_size=128,
-            num_workers=dataset.N_WORKERS)
-            for env, _ in (out_splits + uda_splits)]
+        eval_envs = [env for env, _ in (out_splits + uda_splits)]
     else:
-        eval_loaders = [FastDataLoader(
-        dataset=env,
-        batch_size=128,
-        num_workers=dataset.N_WORKERS)
-        for env, _ in (in_splits + out_splits + uda_splits)]
+        eval_envs = [env for env, _ in (in_splits + out_splits + uda_splits)]
     
     # #eval_weights = [None for _, weights in (in_splits + out_splits + uda_splits)]
     if hparams['custom_train_val']:
@@ -401,11 +499,36 @@ if __name__ == "__main__":
     eval_loader_names += ['env{}_uda'.format(i)
                           for i in range(len(uda_splits))]
 
+    evaluator_kwargs = dict(
+        val_id=hparams['custom_val'],
+        randconv=hparams['val_augmentation'],
+        subsample_size=args.eval_subsample,
+        seed=args.trial_seed,
+        # model selection only reads the out splits and the test envs
+        skip=[name for name in eval_loader_names
+              if args.eval_selection_envs and name.endswith('_in')
+              and int(name[3]) not in args.test_envs])
+    if args.async_eval:
+        evaluator = None  # built by the evaluation worker
+    else:
+        evaluator = CheckpointEvaluator(
+            list(zip(eval_loader_names, eval_envs, eval_weights)),
+            device, dataset.N_WORKERS, batch_augment=dataset.batch_augment,
+            **evaluator_kwargs)
+
     
-    print(len(train_loaders)," length of train loader ++++++++++++++++")
-    train_minibatches_iterator = zip(*train_loaders)
+    ME_ADA_k = loop_state["ME_ADA_k"] if loop_state else 0
+    train_batches = loop_state["train_batches"] if loop_state else 0
+    train_minibatches_iterator = train_minibatches(
+        [(algorithm.train_env(env), w) for env, w in in_splits], hparams,
+        dataset.N_WORKERS, device, args,
+        seed=misc.seed_hash(args.seed, 'train', ME_ADA_k),
+        start_batch=train_batches)
     uda_minibatches_iterator = zip(*uda_loaders)
-    checkpoint_vals = collections.defaultdict(lambda: [])
+    if args.prefetch_batches > 0 and args.task == "domain_adaptation":
+        uda_minibatches_iterator = DevicePrefetcher(
+            uda_minibatches_iterator, device, args.prefetch_batches)
+    checkpoint_vals = misc.MetricAccumulator()
 
     if args.dataset == "DIGITS" or args.dataset == "PACS":
         print("steps_per_epoch ",dataset.STEPS_PER_EPOCH)
@@ -422,20 +545,58 @@ if __name__ == "__main__":
     checkpoint_freq = args.checkpoint_freq or dataset.CHECKPOINT_FREQ
     print(f"+ checkpoint_freq: {checkpoint_freq}")
 
-
-    def save_checkpoint(filename):
-        if args.skip_model_save:
+    epochs_path = os.path.join(args.output_dir, 'results.jsonl')
+    if loop_state is not None:
+        start_step = loop_state["step"]
+        n_steps = loop_state["n_steps"]
+        steps_per_epoch = loop_state["steps_per_epoch"]
+        checkpoint_freq = loop_state["checkpoint_freq"]
+        # drop the records written after the checkpoint we resume from
+        if os.path.exists(epochs_path):
+            with open(epochs_path, 'r') as f:
+                lines = [line for line in f
+                         if json.loads(line)['step'] < start_step]
+            with open(epochs_path, 'w') as f:
+                f.writelines(lines)
+
+
+    checkpoint_writer = AsyncCheckpointWriter()
+
+    def save_checkpoint(filenames):
+        """Snapshot the model (it stays on its device) and write it to every
+        file in `filenames` on a background thread."""
+        if args.skip_model_save or not filenames:
             return
+        training_state = {
+            "optimizers": algorithm.training_state_dict(),
+            "rng": get_rng_state(),
+            "loop": {
+                "step": step + 1,
+                "epoch": epoch,
+                "ME_ADA_k": ME_ADA_k,
+                "final_epoch": final_epoch,
+                "n_steps": n_steps,
+                "steps_per_epoch": steps_per_epoch,
+                "checkpoint_freq": checkpoint_freq,
+                "best_val_acc": best_val_acc,
+                "best_step": best_step,
+                "train_batches": train_batches,
+            },
+        }
+        (model_dict, training_state), event = checkpoint_writer.snapshot(
+            (algorithm.state_dict(), training_state))
         save_dict = {
-            "args": vars(args),
+            "args": dict(vars(args)),
             "model_input_shape": dataset.input_shape,
             "model_num_classes": dataset.num_classes,
             "model_num_domains": len(dataset) - len(args.test_envs),
-            "model_hparams": hparams,
-            "model_dict": algorithm.cpu().state_dict(),
-            
+            "model_hparams": dict(hparams),
+            "model_dict": model_dict,
+            "training_state": training_state,
         }
-        torch.save(save_dict, os.path.join(args.output_dir, filename))
+        checkpoint_writer.save(save_dict,
+            [os.path.join(args.output_dir, filename) for filename in filenames],
+            event, step=step)
 
 
     def save_checkpoint_best(filename, algo):
@@ -456,10 +617,45 @@ if __name__ == "__main__":
 
     last_results_keys = None
     best_val_acc = 0
+    best_step = -1
     step = start_step
     epoch = 0
     final_epoch = round(n_steps/steps_per_epoch)
-    ME_ADA_k = 0
+    if loop_state is not None:
+        best_val_acc = loop_state["best_val_acc"]
+        best_step = loop_state["best_step"]
+        epoch = loop_state["epoch"]
+        final_epoch = loop_state["final_epoch"]
+        set_rng_state(training_state["rng"])
+
+    eval_worker = None
+    if args.async_eval:
+        best_save_dict = None
+        if args.save_best_model and not args.skip_model_save:
+            best_save_dict = {
+                "args": dict(vars(args)),
+                "model_input_shape": dataset.input_shape,
+                "model_num_classes": dataset.num_classes,
+                "model_num_domains": len(dataset) - len(args.test_envs),
+                "model_hparams": dict(hparams),
+            }
+        eval_worker = EvalWorker(type(algorithm),
+            (dataset.input_shape, dataset.num_classes,
+             len(dataset) - len(args.test_envs), dict(hparams)),
+            (args.dataset, args.data_dir, args.test_envs, dataset_hparams,
+             args.seed),
+            list(zip(eval_loader_names,
+                     [split_keys(dataset, env) for env in eval_envs],
+                     eval_weights)),
+            device, args.output_dir,
+            save_dict=best_save_dict, best=(best_val_acc, best_step),
+            **evaluator_kwargs)
+
+    phase_timer = PhaseTimer(device).activate() if args.time_phases else None
+    update_profiler = WindowProfiler(parse_window(args.profile_steps),
+                                     args.output_dir, 'update')
+    eval_profiler = WindowProfiler(parse_window(args.profile_eval_steps),
+                                   args.output_dir, 'eval', per_call=True)
 
     adverserial_algorithms = ["ME_ADA_ViT","ME_ADA_CNN","ADA_CNN","ADA_ViT"]
     
@@ -483,7 +679,16 @@ if __name__ == "__main__":
 
             if (args.algorithm in adverserial_algorithms) and ((epoch+1)%hparams["epochs_min"]==0) and (ME_ADA_k<hparams["k"]):
                 print("Augmenting the Dataset >>>>>>>>>>")
-                in_splits, train_minibatches_iterator = ME_ADA_AUGMENT(in_splits, algorithm,device, dataset.N_WORKERS, hparams, args)
+                n_original = len(in_splits[0][0].data)
+                with timing.phase("me_ada_augment", device=False):
+                    in_splits, train_minibatches_iterator = ME_ADA_AUGMENT(in_splits, algorithm,device, dataset.N_WORKERS, hparams, args,
+                        seed=misc.seed_hash(args.seed, 'train', ME_ADA_k + 1))
+                train_batches = 0
+                if not args.skip_model_save:
+                    # kept so that a resumed run can rebuild the dataset
+                    torch.save({"data": list(in_splits[0][0].data[n_original:]),
+                                "targets": in_splits[0][0].targets[n_original:]},
+                               os.path.join(args.output_dir, f'me_ada_augment{ME_ADA_k}.pkl'))
                 n_steps, steps_per_epoch = ME_ADA_STEP(in_splits, epoch, final_epoch, hparams['batch_size'], step)
                 print("Total steps ",n_steps," Steps per Epoch ",steps_per_epoch)
                 ME_ADA_k+=1
@@ -493,20 +698,43 @@ if __name__ == "__main__":
                     algorithm.scheduler.T_max = hparams["total_steps"]
 
         step_start_time = time.time()
-        minibatches_device = [(x.to(device), y.to(device))
-                              for x, y in next(train_minibatches_iterator)]
-        if args.task == "domain_adaptation":
-            uda_device = [x.to(device)
-                          for x, _ in next(uda_minibatches_iterator)]
-        else:
-            uda_device = device
+        with timing.phase("data_wait", device=False):
+            minibatches = next(train_minibatches_iterator)
+            if args.task == "domain_adaptation":
+                uda = next(uda_minibatches_iterator)
+        train_batches += 1
+        with timing.phase("h2d_copy"):
+            # DevicePrefetcher batches are already device-resident, .to() is a no-op
+            minibatches_device = [(x.to(device), y.to(device))
+                                  for x, y in minibatches]
+            if args.task == "domain_adaptation":
+                uda_device = [x.to(device) for x, _ in uda]
+            else:
+                uda_device = device
+        if dataset.batch_augment is not None:
+            # train envs yield uint8 batches, augmented here on the device
+            with timing.phase("batch_augment"):
+                minibatches_device = [
+                    (dataset.batch_augment(x) if x.dtype == torch.uint8 else x, y)
+                    for x, y in minibatches_device]
+                if args.task == "domain_adaptation":
+                    uda_device = [dataset.batch_augment(x) if x.dtype == torch.uint8 else x
+                                  for x in uda_device]
         
-        step_vals = algorithm.update(minibatches_device, uda_device)
+        with timing.phase("update"), update_profiler(step):
+            step_vals = algorithm.update(minibatches_device, uda_device)
+        # host (kernel launch) time of the step, before anything waits for
+        # the device
+        step_host_time = time.time() - step_start_time
+        if args.sync_metrics:
+            step_vals = {key: float(val) for key, val in step_vals.items()}
         
-        checkpoint_vals['step_time'].append(time.time() - step_start_time)
-
-        for key, val in step_vals.items():
-            checkpoint_vals[key].append(val)
+        # without --sync_metrics nothing waits for the device, so step_time
+        # equals step_host_time; --time_phases gives the device times of
+        # the phases
+        step_vals['step_time'] = time.time() - step_start_time
+        step_vals['step_host_time'] = step_host_time
+        checkpoint_vals.add(step_vals)
         # print("Training done")
         if (step % checkpoint_freq == 0) or (step == n_steps - 1):
             results = {
@@ -514,8 +742,7 @@ if __name__ == "__main__":
                 'epoch': epoch,
             }
 
-            for key, val in checkpoint_vals.items():
-                results[key] = np.mean(val)
+            results.update(checkpoint_vals.reduce())
 
             # Training = []
             # for m in algorithm.network.modules():
@@ -530,48 +757,49 @@ if __name__ == "__main__":
             #     print ("Batch Norm layers are NOT training")
 
 
-            evals = zip(eval_loader_names, eval_loaders, eval_weights)
-            temp_acc = 0
-            temp_count = 0
-            
-            for name, loader, weights in evals:
-                acc,loss = misc.accuracy(algorithm, loader, weights, device,val_id=hparams['custom_val'],current_id=int(name[3]),randconv=hparams['val_augmentation'])
-                if args.save_best_model:
-                    #if int(name[3]) not in args.test_envs and "out" in name:
-                    if hparams['custom_val'] == int(name[3]) and "out" in name:
-                        temp_acc += acc
-                        temp_count += 1
-                results[name + '_acc'] = acc
-                results[name + '_loss'] = loss
-            
-            # print("Validation done")    
-            if args.save_best_model:
-                val_acc = temp_acc / (temp_count * 1.0)
-                if val_acc >= best_val_acc:
+            results['mem_gb'] = torch.cuda.max_memory_allocated() / (1024. * 1024. * 1024.)
+            # the snapshot time is the previous checkpoint's; the write time is
+            # that of the last finished write (not waited for), of the step
+            # logged as checkpoint_write_step
+            results['checkpoint_snapshot_time'] = checkpoint_writer.last_snapshot_time
+            results['checkpoint_write_time'] = checkpoint_writer.last_write_time
+            results['checkpoint_write_step'] = checkpoint_writer.last_write_step
+            checkpoint_files = []
+            if phase_timer is not None:
+                # eval and checkpoint times of the previous checkpoint
+                results.update(phase_timer.summary())
+
+            if eval_worker is not None:
+                # evaluated and written by the worker; training goes on
+                eval_worker.poll()
+                best_val_acc, best_step = eval_worker.best_val_acc, eval_worker.best_step
+                results.update({
+                    'hparams': dict(hparams),
+                    'args': vars(args)
+                })
+                with timing.phase("eval", device=False):
+                    eval_worker.submit(step, algorithm.state_dict(), results,
+                                       final=step == n_steps - 1)
+            else:
+                with timing.phase("eval", device=False), eval_profiler(step):
+                    eval_results, val_acc, full_eval = evaluator(algorithm,
+                        final=step == n_steps - 1, best_val_acc=best_val_acc)
+                results.update(eval_results)
+
+                # print("Validation done")    
+                if args.save_best_model and full_eval and is_better(val_acc, step, best_val_acc, best_step):
                     # model_save = algorithm.detach().clone()  # clone
                     # model_save = copy.deepcopy(algorithm)  # clone
-                    if (args.save_best_model):
-                        save_checkpoint('IID_best.pkl')
-                        algorithm.to(device)
-                    best_val_acc = val_acc
+                    checkpoint_files.append('IID_best.pkl')
+                    best_val_acc, best_step = val_acc, step
                     print("Best model upto now")
-            results['mem_gb'] = torch.cuda.max_memory_allocated() / (1024. * 1024. * 1024.)
-
-            results_keys = sorted(results.keys())
-            if results_keys != last_results_keys:
-                misc.print_row(results_keys, colwidth=12)
-                last_results_keys = results_keys
-            misc.print_row([results[key] for key in results_keys],
-                           colwidth=12)
-
-            results.update({
-                'hparams': hparams,
-                'args': vars(args)
-            })
 
-            epochs_path = os.path.join(args.output_dir, 'results.jsonl')
-            with open(epochs_path, 'a') as f:
-                f.write(json.dumps(results, sort_keys=True) + "\n")
+                results.update({
+                    'hparams': hparams,
+                    'args': vars(args)
+                })
+                last_results_keys = write_results(results, args.output_dir,
+                                                  last_results_keys)
 
             # writer.add_scalar("val_acc",results["env1_out_acc"],results["step"])
             # writer.add_scalar("val_loss",results["env1_out_loss"],results["step"])
@@ -583,7 +811,7 @@ if __name__ == "__main__":
             #     writer.add_scalar("train_loss",results["loss"],results["step"])
             algorithm_dict = algorithm.state_dict()
             start_step = step + 1
-            checkpoint_vals = collections.defaultdict(lambda: [])
+            checkpoint_vals = misc.MetricAccumulator()
             
             
             # records = []
@@ -595,15 +823,20 @@ if __name__ == "__main__":
             # if scores[-1] == scores.argmax('val_acc'):
             #     save_checkpoint('IID_best.pkl')
             #     algorithm.to(device)
-            save_checkpoint(f'model_step_last.pkl')
-            algorithm.to(device)
+            checkpoint_files.append(f'model_step_last.pkl')
             if args.save_model_every_checkpoint:
-                save_checkpoint(f'model_step{step}.pkl')
+                checkpoint_files.append(f'model_step{step}.pkl')
+            with timing.phase("checkpoint", device=False):
+                save_checkpoint(checkpoint_files)
 
         step+=1
         # print("One iteration done")
 
-    save_checkpoint('model.pkl')
+    update_profiler.close()
+    save_checkpoint(['model.pkl'])
+    checkpoint_writer.wait()
+    if eval_worker is not None:
+        eval_worker.close()
     #writer.close()
     # if (args.save_best_model):
     #     save_checkpoint_best('IID_best.pkl', model_save)
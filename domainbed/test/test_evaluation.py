@@ -0,0 +1,54 @@
+import random
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from domainbed import datasets
+from domainbed.lib import misc
+from domainbed.lib.evaluation import rebuild_dataset, rebuild_split, split_keys
+
+
+class ShuffledEnvs(datasets.MultipleDomainDataset):
+    """Like MultipleEnvironmentMNIST, shuffles its samples into environments
+    with the global torch RNG."""
+    ENVIRONMENTS = ['0', '1', '2']
+
+    def __init__(self, root, test_envs, hparams):
+        super().__init__()
+        targets = torch.arange(300)[torch.randperm(300)]
+        self.datasets = [TensorDataset(targets[i::3].float(), targets[i::3])
+                         for i in range(3)]
+
+
+class TestRebuildDataset(unittest.TestCase):
+
+    @mock.patch.dict(vars(datasets), {'ShuffledEnvs': ShuffledEnvs})
+    def test_rebuilt_splits_match(self):
+        seed = 7
+        # train.py seeds the RNGs right before building the dataset
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        dataset = ShuffledEnvs(None, [0], {})
+        splits = []
+        for env_i, env in enumerate(dataset):
+            out, in_ = misc.split_dataset(env, len(env) // 5,
+                                          misc.seed_hash(0, env_i))
+            splits += [env, out, in_]
+
+        # the worker consumes its RNGs before building the dataset
+        torch.rand(10)
+        rebuilt = rebuild_dataset(('ShuffledEnvs', None, [0], {}, seed))
+        for split in splits:
+            env_i, keys = split_keys(dataset, split)
+            rebuilt_split = rebuild_split(rebuilt, env_i, keys)
+            self.assertEqual(
+                [y.item() for _, y in split],
+                [y.item() for _, y in rebuilt_split])
+
+
+if __name__ == '__main__':
+    unittest.main()
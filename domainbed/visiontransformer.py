@@ -541,6 +541,9 @@ class VisionTransformer_MNIST(nn.Module):
 class VisionTransformer_Random_Block(nn.Module):
     """ Vision Transformer with support for patch or hybrid CNN input stage
     """
+    # forward draws a random block on the host, networks.compile_network
+    # compiles the submodules and keeps this forward eager
+    COMPILE_PER_CHILD = True
 
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,